@@ -0,0 +1,77 @@
+import re
+import sys
+import time
+
+from md_converter import HTMLToMarkdownConverter, MarkdownWriter
+
+
+def build_page(n_paragraphs, n_rows):
+    # A large synthetic Confluence page: many paragraphs and a long table
+    parts = ['<h1 id="title-heading">SPACE : Large page</h1>']
+    for i in range(n_paragraphs):
+        parts.append(f'<p>Paragraph {i} with <a href="Page_{i}.html">a link</a> '
+                     f'and <strong>some bold text</strong>.</p>')
+    parts.append('<table><tr><th>Name</th><th>Value</th><th>Notes</th></tr>')
+    for i in range(n_rows):
+        parts.append(f'<tr><td>row {i}</td><td><code>{i * 7}</code></td>'
+                     f'<td><em>note</em> {i}</td></tr>')
+    parts.append('</table>')
+    return '<html><body>' + '\n'.join(parts) + '</body></html>'
+
+
+class ConcatOutput:
+    # How the converter used to build its output: one attribute grown with +=
+    def __init__(self):
+        self.markdown = ''
+
+    def write(self, text):
+        self.markdown += text
+
+    def getvalue(self):
+        return re.sub(r'\n\n+', '\n\n', self.markdown.strip())
+
+
+class RecordingConverter(HTMLToMarkdownConverter):
+    def __init__(self, table):
+        super().__init__(table)
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)
+        super().write(text)
+
+
+def replay(output, writes):
+    start = time.perf_counter()
+    for text in writes:
+        output.write(text)
+    result = output.getvalue()
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(n_paragraphs, n_rows):
+    html = build_page(n_paragraphs, n_rows)
+    start = time.perf_counter()
+    HTMLToMarkdownConverter({}).convert(html)
+    convert_time = time.perf_counter() - start
+
+    # Capture the exact sequence of writes the handlers make and feed it to
+    # both buffers, so only the output accumulation is being measured
+    recorder = RecordingConverter({})
+    recorder.convert(html)
+
+    concat_result, concat_time = replay(ConcatOutput(), recorder.writes)
+    writer_result, writer_time = replay(MarkdownWriter(), recorder.writes)
+    assert concat_result == writer_result
+
+    print(f"{n_paragraphs} paragraphs, {n_rows} table rows, "
+          f"{len(html) / 1e6:.1f} MB HTML, {len(recorder.writes)} writes")
+    print(f"  convert():        {convert_time:8.3f} s")
+    print(f"  += concatenation: {concat_time:8.3f} s")
+    print(f"  MarkdownWriter:   {writer_time:8.3f} s")
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for size in (5000, 20000, 80000):
+        run_benchmark(size * scale, size * scale // 4)
@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+from confluence_export_generator import ConfluenceExportGenerator
+import md_converter
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {
+        'count': len(samples),
+        'mean_ms': 1000 * sum(samples) / len(samples),
+        'p50_ms': 1000 * at(0.50),
+        'p90_ms': 1000 * at(0.90),
+        'p99_ms': 1000 * at(0.99),
+        'max_ms': 1000 * samples[-1],
+    }
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; worker processes are counted too
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_index(index_path, parser, repeat):
+    with open(index_path, 'r', encoding='utf-8') as file:
+        html = file.read()
+    parse_times, toc_times = [], []
+    for _ in range(repeat):
+        model, elapsed = timed(md_converter.build_index, html, parser)
+        parse_times.append(elapsed)
+        start = time.perf_counter()
+        toc_tree = md_converter.create_toc_tree([dict(item) for item in model['toc_structure']])
+        md_converter.build_toctree_index(toc_tree)
+        toc_times.append(time.perf_counter() - start)
+    return model, {'index_parse': percentiles(parse_times), 'toc_tree': percentiles(toc_times)}
+
+
+def bench_convert(export_folder, table, parser, repeat):
+    pages = []
+    for file_name in sorted(os.listdir(export_folder)):
+        if file_name.endswith('.html') and file_name != 'index.html':
+            with open(os.path.join(export_folder, file_name), 'r', encoding='utf-8') as file:
+                pages.append(file.read())
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            converter = md_converter.HTMLToMarkdownConverter(table, parser)
+            _, elapsed = timed(converter.convert, html)
+            latencies.append(elapsed)
+    total = time.perf_counter() - start
+
+    megabytes = repeat * sum(len(html.encode('utf-8')) for html in pages) / 1e6
+    stage = percentiles(latencies)
+    stage['pages_per_sec'] = len(latencies) / total
+    stage['mb_per_sec'] = megabytes / total
+    return stage
+
+
+def bench_pipeline(export_folder, output_folder, parser, n_workers):
+    md_converter.source_folder = export_folder
+    md_converter.index_file = os.path.join(export_folder, 'index.html')
+    md_converter.destination_folder = output_folder
+    md_converter.index_rst = os.path.join(output_folder, 'index.rst')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, elapsed = timed(md_converter.run_conversion, n_workers, False, parser)
+
+    n_pages = sum(1 for name in os.listdir(export_folder) if name.endswith('.html'))
+    megabytes = sum(os.path.getsize(os.path.join(root, name))
+                    for root, _, files in os.walk(export_folder) for name in files) / 1e6
+    return {'wall_s': elapsed, 'pages_per_sec': n_pages / elapsed,
+            'mb_per_sec': megabytes / elapsed, 'workers': n_workers}
+
+
+def compare(result, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    print(f"\nAgainst {baseline_path} (revision {baseline.get('revision')}):")
+    for stage, metrics in result['stages'].items():
+        old = baseline.get('stages', {}).get(stage, {})
+        for key in ('p50_ms', 'p99_ms', 'pages_per_sec', 'wall_s'):
+            if key in metrics and old.get(key):
+                print(f"  {stage:<12} {key:<14} {old[key]:>10.2f} -> {metrics[key]:>10.2f} "
+                      f"({metrics[key] / old[key]:.2f}x)")
+
+
+def run_benchmark(args):
+    generator = ConfluenceExportGenerator(
+        pages=args.pages, paragraphs=args.paragraphs, nesting=args.nesting,
+        tables=args.tables, table_rows=args.table_rows, table_columns=args.table_columns,
+        links=args.links, images=args.images, index_depth=args.index_depth,
+        attachments=args.attachments, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep the run's caches out of the user's cache folder
+        md_converter.cache_folder = os.path.join(workdir, 'cache')
+        export_folder = generator.write(os.path.join(workdir, 'export'))
+        index_path = os.path.join(export_folder, 'index.html')
+
+        model, stages = bench_index(index_path, args.parser, args.repeat)
+        stages['convert'] = bench_convert(export_folder, model['table'], args.parser, args.repeat)
+        stages['pipeline'] = bench_pipeline(export_folder, os.path.join(workdir, 'out'),
+                                            args.parser, args.workers)
+
+    result = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'compare')},
+        'stages': stages,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+    for stage, metrics in stages.items():
+        print(f"{stage:<12} " + '  '.join(f"{key}={value:.2f}" if isinstance(value, float)
+                                          else f"{key}={value}" for key, value in metrics.items()))
+    print(f"peak RSS: {result['peak_rss_mb']:.1f} MB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=2)
+    if args.compare:
+        compare(result, args.compare)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the converter on a synthetic Confluence export")
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--paragraphs', type=int, default=40, help="paragraphs per page")
+    parser.add_argument('--nesting', type=int, default=3, help="layout and list nesting depth")
+    parser.add_argument('--tables', type=int, default=2, help="tables per page")
+    parser.add_argument('--table-rows', type=int, default=20)
+    parser.add_argument('--table-columns', type=int, default=4)
+    parser.add_argument('--links', type=float, default=2, help="links per paragraph")
+    parser.add_argument('--images', type=float, default=0.5, help="images per paragraph")
+    parser.add_argument('--index-depth', type=int, default=4)
+    parser.add_argument('--attachments', type=int, default=20, help="attachments per page")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--parser', default='html.parser')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run_benchmark(parse_args())
@@ -1,32 +1,10 @@
-import bs4
-import re
-import urllib.parse
+import sys
 
-def extract_toc_structure(html_file):
-    with open(html_file, 'r', encoding='utf-8') as file:
-        soup = bs4.BeautifulSoup(file, 'html.parser')
+from html_parsers import resolve_parser
+# index.html is parsed once and cached by md_converter.load_index, shared
+# with the URL table used by the converter
+from md_converter import extract_toc_structure
 
-    def calculate_indentation(tag):
-        indentation = 0
-        parent = tag.find_parent(['ul'])
-        while parent:
-            indentation += 1
-            parent = parent.find_parent(['ul'])
-        return indentation
-
-    toc_structure = []
-
-    for anchor in soup.find_all('a', href=True):
-        link = anchor['href']
-        if link.endswith('.html'):
-            text = re.sub(r' +', ' ', anchor.get_text().replace('\n', ' '))
-            indentation = calculate_indentation(anchor)
-
-            url = convert_to_valid_url(text)
-
-            toc_structure.append({'text': text, 'link': url, 'indentation': indentation})
-
-    return toc_structure
 
 def create_toc_tree(toc_structure):
     toc_tree = []
@@ -49,11 +27,6 @@ def create_toc_tree(toc_structure):
     print(toc_tree)
     return toc_tree
 
-def convert_to_valid_url(input_string):
-    url_string = re.sub(r' +', ' ', input_string.replace('\n', ' ')).replace(' ', '_')
-    url_string = urllib.parse.quote(url_string, safe=':()?&=#')
-    return url_string.replace('.html', '.md')
-
 def write_toc_to_rst(toc_tree, file_path):
     with open(file_path, 'w', encoding='utf-8') as rst_file:
         write_toc_tree_to_rst(toc_tree, rst_file)
@@ -74,7 +47,8 @@ def write_toc_tree_to_rst(toc_tree, rst_file, depth=0):
 
 if __name__ == "__main__":
     html_file = '/home/guillermo/Portal/py/md_converter/test1/ARTPLATSWS/index.html'
-    toc_structure = extract_toc_structure(html_file)
+    parser = resolve_parser(sys.argv[1] if len(sys.argv) > 1 else 'html.parser')
+    toc_structure = extract_toc_structure(html_file, parser)
     toc_tree = create_toc_tree(toc_structure)
     toctree_rst_file = '/home/guillermo/Portal/py/md_converter/test1/source/ARTPLATSWS/index.rst'
     write_toc_to_rst(toc_tree, toctree_rst_file)
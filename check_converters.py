@@ -0,0 +1,161 @@
+import argparse
+import io
+import random
+import sys
+
+from md_converter import HTMLToMarkdownConverter, NoiseFilter, space_noise
+from md_stream_converter import StreamingMarkdownConverter
+
+# Text and inline markup the generated pages are made of
+words = ['x', 'y z', ' w ', 'a-b', '\n']
+# Markup of misnested pages, in any order, and the noise regions put in them
+page_markup = ['<div>', '</div>', '<p>', '</p>', '<td>', '</td>', '<table>', '</table>', '<tr>',
+               '<ul>', '</ul>', '<li>', '</li>', '<h2>', '</h2>', '<strong>', '</strong>',
+               '<a href="https://example.org">', '</a>', ' text ', '\n', '<!-- <div> -->']
+noise_regions = [('<div class="pageSection">', '</div>'), ('<div id="footer">', '</div>'),
+                 ('<ul class="toc-indentation">', '</ul>')]
+
+
+def tree_markdown(html, parser='html.parser'):
+    return HTMLToMarkdownConverter({}, parser).convert(html)
+
+
+def stream_markdown(html):
+    return StreamingMarkdownConverter({}).convert(io.StringIO(html))
+
+
+def inline(rng, depth):
+    choice = rng.random()
+    if depth > 2 or choice < 0.4:
+        return rng.choice(words)
+    if choice < 0.55:
+        tag = rng.choice(['strong', 'em', 's', 'code'])
+        return f"<{tag}>{inline(rng, depth + 1)}</{tag}>"
+    if choice < 0.7:
+        return f'<a href="https://example.org/{depth}">{inline(rng, depth + 1)}</a>'
+    if choice < 0.8:
+        return f'<img src="https://example.org/{depth}.png" alt="{rng.choice(words)}">'
+    return '<br>'
+
+
+def cell_content(rng):
+    # Several paragraphs, blocks and line breaks, as Confluence writes them
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        text = ''.join(inline(rng, 0) for _ in range(rng.randint(1, 3)))
+        parts.append(rng.choice([text, f"<p>{text}</p>", f"<div>{text}</div>",
+                                 f"<ul><li>{text}</li><li>{text}</li></ul>", f"<h2>{text}</h2>"]))
+    return ''.join(parts)
+
+
+def cells_page(rng):
+    # Rows have the same width; the streaming converter pads short rows to
+    # the first one
+    rows = []
+    columns = rng.randint(1, 3)
+    for row in range(rng.randint(1, 4)):
+        tag = 'th' if row == 0 and rng.random() < 0.5 else 'td'
+        cells = ''.join(f"<{tag}>{cell_content(rng)}</{tag}>" for _ in range(columns))
+        rows.append(f"<tr>{cells}</tr>")
+    return f"<p>before</p><table>{''.join(rows)}</table><p>after</p>"
+
+
+def check_cells(rng):
+    # Table cells render the same in the tree and the streaming converter
+    html = cells_page(rng)
+    return tree_markdown(html) == stream_markdown(html), html
+
+
+def list_html(rng, depth):
+    tag = rng.choice(['ul', 'ol'])
+    items = ''.join(f"<li>{item_content(rng, depth)}</li>" for _ in range(rng.randint(1, 3)))
+    return f"<{tag}>{items}</{tag}>"
+
+
+def item_content(rng, depth):
+    # Text, paragraphs and blocks, and the lists, tables and headings that
+    # are written after the item's line
+    parts = []
+    for _ in range(rng.randint(1, 3)):
+        text = ''.join(inline(rng, 0) for _ in range(rng.randint(1, 2)))
+        choice = rng.random()
+        if choice < 0.2 and depth < 2:
+            parts.append(list_html(rng, depth + 1))
+        elif choice < 0.3:
+            parts.append(f"<table><tr><th>k</th><th>v</th></tr>"
+                         f"<tr><td>{text}</td><td>x</td></tr></table>")
+        elif choice < 0.4:
+            parts.append(f"<h2>{text}</h2>")
+        elif choice < 0.55:
+            parts.append(f"<p>{text}</p>")
+        elif choice < 0.7:
+            parts.append(f"<div>{text}</div>")
+        else:
+            parts.append(text)
+    return ''.join(parts)
+
+
+def check_lists(rng):
+    # Nested lists, and the blocks, tables and headings in items, render the
+    # same in the tree and the streaming converter
+    html = f"<p>before</p>{list_html(rng, 0)}<p>after</p>"
+    return tree_markdown(html) == stream_markdown(html), html
+
+
+class TreeNoiseFilter(NoiseFilter):
+    # Always removes the noise regions from the parsed tree
+    def strip(self, html):
+        return None
+
+
+def check_noise(rng):
+    # Cutting noise regions out of the HTML gives what removing them from
+    # the tree html.parser builds gives
+    parts = []
+    for _ in range(rng.randint(1, 3)):
+        start, end = rng.choice(noise_regions)
+        parts += [rng.choice(page_markup) for _ in range(rng.randint(0, 5))] + [start]
+        parts += [rng.choice(page_markup) for _ in range(rng.randint(0, 5))]
+        if rng.random() < 0.8:
+            parts.append(end)
+    parts += [rng.choice(page_markup) for _ in range(rng.randint(0, 5))]
+    html = ''.join(parts)
+    noise = space_noise()
+    tree_noise = TreeNoiseFilter(noise.selectors)
+    return HTMLToMarkdownConverter({}, noise=noise).convert(html) == \
+        HTMLToMarkdownConverter({}, noise=tree_noise).convert(html), html
+
+
+checks = {'cells': check_cells, 'lists': check_lists, 'noise': check_noise}
+
+
+def run_checks(names, pages, seed):
+    # Prints a line per check and returns the number of failing pages
+    failed = 0
+    for name in names:
+        rng = random.Random(seed)
+        failures = []
+        for _ in range(pages):
+            same, html = checks[name](rng)
+            if not same:
+                failures.append(html)
+        print(f"{name:<8} {pages - len(failures)}/{pages} pages agree")
+        for html in failures[:3]:
+            print(f"    differs: {html!r}")
+        failed += len(failures)
+    return failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare converter paths that must agree on generated pages")
+    parser.add_argument('checks', nargs='*', choices=[[]] + list(checks),
+                        help="checks to run, all by default")
+    parser.add_argument('--pages', type=int, default=1000, help="pages per check")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(1 if run_checks(args.checks or list(checks), args.pages, args.seed) else 0)
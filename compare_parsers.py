@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from html_parsers import available_parsers
+from md_converter import HTMLToMarkdownConverter
+
+# Output of every backend is checked against this one
+reference_parser = 'html.parser'
+
+
+def collect_pages(folder):
+    pages = []
+    for root, _, files in os.walk(folder):
+        for file_name in files:
+            if file_name.endswith('.html'):
+                with open(os.path.join(root, file_name), 'r', encoding='utf-8') as file:
+                    pages.append((file_name, file.read()))
+    return pages
+
+
+def measure_parse(pages, parser):
+    start = time.perf_counter()
+    for _, html in pages:
+        BeautifulSoup(html, parser)
+    parse_time = time.perf_counter() - start
+
+    # Peak memory of parsing the largest page, measured separately so that
+    # tracemalloc does not slow down the timing above
+    _, largest = max(pages, key=lambda page: len(page[1]))
+    tracemalloc.start()
+    soup = BeautifulSoup(largest, parser)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del soup
+    return parse_time, peak
+
+
+def measure_convert(pages, parser):
+    # Links are rewritten without a URL table; it is the same for every
+    # backend so it does not affect the comparison
+    outputs = {}
+    start = time.perf_counter()
+    for file_name, html in pages:
+        outputs[file_name] = HTMLToMarkdownConverter({}, parser).convert(html)
+    return time.perf_counter() - start, outputs
+
+
+def compare_parsers(folder):
+    pages = collect_pages(folder)
+    total_mb = sum(len(html) for _, html in pages) / 1e6
+    print(f"{len(pages)} pages, {total_mb:.1f} MB of HTML in {folder}\n")
+
+    parsers = available_parsers()
+    _, reference = measure_convert(pages, reference_parser)
+
+    print(f"{'backend':<12} {'parse s':>9} {'MB/s':>7} {'peak MB':>8} "
+          f"{'convert s':>10} {'differing pages':>16}")
+    for parser in parsers:
+        parse_time, peak = measure_parse(pages, parser)
+        convert_time, outputs = measure_convert(pages, parser)
+        differing = [file_name for file_name, markdown in outputs.items()
+                     if markdown != reference[file_name]]
+        print(f"{parser:<12} {parse_time:>9.3f} {total_mb / parse_time:>7.1f} "
+              f"{peak / 1e6:>8.1f} {convert_time:>10.3f} {len(differing):>16}")
+        for file_name in differing[:5]:
+            print(f"    differs: {file_name}")
+
+
+if __name__ == "__main__":
+    compare_parsers(sys.argv[1] if len(sys.argv) > 1 else '.')
@@ -0,0 +1,165 @@
+import os
+import random
+import sys
+
+words = ('alpha beta gamma delta rig slipstream measure test log value signal '
+         'brake sensor calibration the a of and to with for').split()
+
+
+class ConfluenceExportGenerator:
+    # Writes a synthetic Confluence HTML space export: index.html with a
+    # nested page tree, one HTML page per entry and attachments referenced
+    # from the pages. Every dimension that affects conversion cost is
+    # configurable, and the same seed always produces the same export.
+    def __init__(self, pages=100, paragraphs=40, nesting=3, tables=2,
+                 table_rows=20, table_columns=4, links=2, images=0.5,
+                 index_depth=4, attachments=20, space='BENCH', seed=1):
+        self.pages = pages
+        self.paragraphs = paragraphs
+        self.nesting = nesting
+        self.tables = tables
+        self.table_rows = table_rows
+        self.table_columns = table_columns
+        self.links = links
+        self.images = images
+        self.index_depth = index_depth
+        self.attachments = attachments
+        self.space = space
+        self.random = random.Random(seed)
+        self.file_names = [f"Page-{i}_{100000 + i}.html" for i in range(pages)]
+        self.titles = [f"Page {i} {self.words(2)}" for i in range(pages)]
+
+    def words(self, n):
+        return ' '.join(self.random.choice(words) for _ in range(n))
+
+    def count(self, density):
+        # Fractional densities become a probability of one more element
+        whole = int(density)
+        return whole + (self.random.random() < density - whole)
+
+    def link(self):
+        if self.random.random() < 0.8:
+            return f'<a href="{self.random.choice(self.file_names)}">{self.words(2)}</a>'
+        return f'<a href="https://example.com/{self.random.choice(words)}">{self.words(1)}</a>'
+
+    def image(self, page_id):
+        attachment = self.random.randrange(max(1, self.attachments))
+        return (f'<img class="confluence-embedded-image" '
+                f'src="attachments/{page_id}/{attachment}.png" alt="{self.words(1)}">')
+
+    def inline_text(self, page_id):
+        parts = [self.words(self.random.randint(3, 12))]
+        for _ in range(self.count(self.links)):
+            parts.append(self.link())
+            parts.append(self.words(self.random.randint(1, 6)))
+        for _ in range(self.count(self.images)):
+            parts.append(self.image(page_id))
+        if self.random.random() < 0.3:
+            parts.append(f'<strong>{self.words(2)}</strong>')
+        if self.random.random() < 0.2:
+            parts.append(f'<code>{self.random.choice(words)}</code>')
+        self.random.shuffle(parts)
+        return ' '.join(parts)
+
+    def list_html(self, page_id, depth=0):
+        tag = self.random.choice(['ul', 'ol'])
+        items = []
+        for _ in range(self.random.randint(2, 5)):
+            item = self.inline_text(page_id)
+            if depth + 1 < self.nesting and self.random.random() < 0.3:
+                item += self.list_html(page_id, depth + 1)
+            items.append(f'<li>{item}</li>')
+        return f'<{tag}>{"".join(items)}</{tag}>'
+
+    def table_html(self, page_id):
+        widths = ','.join(str(self.random.randint(10, 40)) for _ in range(self.table_columns))
+        rows = ['<tr>' + ''.join(f'<th class="confluenceTh">{self.words(2)}</th>'
+                                 for _ in range(self.table_columns)) + '</tr>']
+        for _ in range(self.table_rows):
+            cells = ''.join(f'<td class="confluenceTd"><p>{self.inline_text(page_id)}</p></td>'
+                            for _ in range(self.table_columns))
+            rows.append(f'<tr>{cells}</tr>')
+        return (f'<div class="table-wrap"><table class="confluenceTable" '
+                f'data-column-widths="{widths}"><tbody>{"".join(rows)}</tbody></table></div>')
+
+    def nest(self, html):
+        # Wrap content in layout divs the way Confluence page layouts do
+        for _ in range(self.nesting):
+            html = f'<div class="columnLayout"><div class="cell normal"><div class="innerCell">{html}</div></div></div>'
+        return html
+
+    def page_html(self, i):
+        page_id = 100000 + i
+        blocks = []
+        table_at = set(self.random.sample(range(self.paragraphs + 1),
+                                          min(self.tables, self.paragraphs + 1)))
+        for n in range(self.paragraphs):
+            if n % 10 == 0:
+                level = self.random.randint(1, 3)
+                blocks.append(f'<h{level}>{self.words(3)}</h{level}>')
+            if n in table_at:
+                blocks.append(self.table_html(page_id))
+            if self.random.random() < 0.1:
+                blocks.append(self.list_html(page_id))
+            blocks.append(f'<p>{self.inline_text(page_id)}</p>')
+        content = self.nest('\n'.join(blocks))
+        attachments = ''.join(f'<img src="images/icons/bullet_blue.gif" height="8" width="8" alt=""/>'
+                              f'<a href="attachments/{page_id}/{n}.png">{n}.png</a> (image/png)<br/>'
+                              for n in range(min(self.attachments, 10)))
+        return f'''<!DOCTYPE html>
+<html><head><title>{self.space} : {self.titles[i]}</title></head>
+<body class="theme-default aui-theme-default"><div id="page"><div id="main" class="aui-page-panel">
+<div id="main-header"><div id="breadcrumb-section"><ol id="breadcrumbs">
+<li class="first"><span><a href="index.html">{self.space}</a></span></li></ol></div>
+<h1 id="title-heading" class="pagetitle"><span id="title-text">{self.space} : {self.titles[i]}</span></h1></div>
+<div id="content" class="view"><div class="page-metadata">Created by <span class='author'> Bench</span></div>
+<div id="main-content" class="wiki-content group">
+{content}
+</div>
+<div class="pageSection group"><div class="pageSectionHeader"><h2 id="attachments" class="pageSectionTitle">Attachments:</h2></div>
+<div class="greybox" align="left">{attachments}</div></div>
+</div></div>
+<div id="footer" role="contentinfo"><section class="footer-body"><p>Document generated by Confluence</p></section></div>
+</div></body></html>'''
+
+    def index_html(self):
+        # Pages are laid out as a tree at most index_depth levels deep below
+        # the space home page
+        def subtree(first, last, depth):
+            items = []
+            i = first
+            while i < last:
+                span = 1 if depth >= self.index_depth else \
+                    min(last - i, self.random.randint(1, max(1, (last - first) // 3)))
+                item = f'<li><a href="{self.file_names[i]}">{self.titles[i]}</a>'
+                if span > 1:
+                    item += f'<ul>{subtree(i + 1, i + span, depth + 1)}</ul>'
+                items.append(item + '</li>')
+                i += span
+            return ''.join(items)
+
+        return (f'<html><head><title>{self.space}</title></head><body>'
+                f'<div id="main-content" class="pageSection"><h2>Available Pages:</h2>'
+                f'<ul><li><a href="index.html">{self.space} Home</a>'
+                f'<ul>{subtree(0, self.pages, 1)}</ul></li></ul></div></body></html>')
+
+    def write(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'index.html'), 'w', encoding='utf-8') as file:
+            file.write(self.index_html())
+        for i, file_name in enumerate(self.file_names):
+            with open(os.path.join(folder, file_name), 'w', encoding='utf-8') as file:
+                file.write(self.page_html(i))
+            attachment_folder = os.path.join(folder, 'attachments', str(100000 + i))
+            os.makedirs(attachment_folder, exist_ok=True)
+            for n in range(self.attachments):
+                with open(os.path.join(attachment_folder, f'{n}.png'), 'wb') as file:
+                    # Half of the attachments repeat across pages
+                    file.write(bytes([n % 256]) * (1024 * (1 + n % 4)) if n % 2 else
+                               self.random.randbytes(1024))
+        return folder
+
+
+if __name__ == "__main__":
+    ConfluenceExportGenerator(pages=int(sys.argv[2]) if len(sys.argv) > 2 else 100) \
+        .write(sys.argv[1] if len(sys.argv) > 1 else 'bench_export')
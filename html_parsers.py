@@ -0,0 +1,24 @@
+import logging
+
+from bs4.builder import builder_registry
+
+# Backends BeautifulSoup can drive, fastest first. lxml is the C-based one;
+# html.parser ships with Python and is always available.
+parser_backends = ['lxml', 'html5lib', 'html.parser']
+
+
+def available_parsers():
+    return [name for name in parser_backends if builder_registry.lookup(name)]
+
+
+def resolve_parser(name=None):
+    # 'auto' (or None) picks the fastest installed backend. An explicitly
+    # requested backend that is not installed falls back the same way.
+    if name and name != 'auto':
+        if builder_registry.lookup(name):
+            return name
+        fallback = available_parsers()[0]
+        logging.warning(
+            f"HTML parser '{name}' is not installed, using '{fallback}'")
+        return fallback
+    return available_parsers()[0]
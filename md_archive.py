@@ -0,0 +1,275 @@
+import io
+import logging
+import os
+import posixpath
+import re
+import shutil
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import md_converter
+from md_converter import (AssetIndex, ConversionCache, ConversionProfiler, ProgressReporter,
+                          _convert_page_task, _init_worker, build_toctree_index,
+                          cache_context, create_toc_tree, index_model, index_rst_text,
+                          is_asset, merge_report, replace_filename, space_noise,
+                          toctree_fragment)
+from html_parsers import resolve_parser
+
+# Output archive formats by file name suffix; anything else is a folder
+archive_formats = {'.zip': 'zip', '.tar': 'w', '.tar.gz': 'w:gz', '.tgz': 'w:gz',
+                   '.tar.bz2': 'w:bz2', '.tar.xz': 'w:xz'}
+
+
+def member_path(name):
+    # Normalized relative path of a member or output name, or None when it
+    # is absolute or has a '..' segment and could land outside the
+    # destination
+    name = name.replace('\\', '/')
+    if name.startswith('/') or re.match(r'[A-Za-z]:', name) or '..' in name.split('/'):
+        return None
+    return posixpath.normpath(name)
+
+
+def archive_format(path):
+    for suffix, mode in archive_formats.items():
+        if path.endswith(suffix):
+            return mode
+    return None
+
+
+class ArchiveReader:
+    # Regular-file members of a zip or tar export, read without extracting
+    # them. Members are listed in archive order, which is the cheap order to
+    # read a compressed tar in.
+    def __init__(self, path):
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            self.members = [(info.filename, info.file_size, info)
+                            for info in self.zip.infolist() if not info.is_dir()]
+        else:
+            self.zip = None
+            self.tar = tarfile.open(path, 'r:*')
+            self.members = [(info.name, info.size, info)
+                            for info in self.tar.getmembers() if info.isfile()]
+
+    def open(self, info):
+        return self.zip.open(info) if self.zip else self.tar.extractfile(info)
+
+    def read(self, info):
+        with self.open(info) as file:
+            return file.read()
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+
+class OutputWriter:
+    # Writes converted pages and assets either into a folder or, when the
+    # destination has an archive suffix, into a new zip or tar archive
+    def __init__(self, destination):
+        self.destination = destination
+        self.mode = archive_format(destination)
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        elif os.path.exists(destination):
+            os.remove(destination)
+        os.makedirs(destination if self.mode is None else
+                    os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+        self.archive = None
+        if self.mode == 'zip':
+            self.archive = zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED)
+        elif self.mode:
+            self.archive = tarfile.open(destination, self.mode)
+
+    def write(self, name, text):
+        data = text.encode('utf-8')
+        self.copy(name, io.BytesIO(data), len(data))
+
+    def copy(self, name, file, size):
+        safe_name = member_path(name)
+        if safe_name is None:
+            raise ValueError(f"Not writing {name!r}, it is outside the destination")
+        name = safe_name
+        if self.mode is None:
+            root = os.path.realpath(self.destination)
+            path = os.path.realpath(os.path.join(root, name))
+            if os.path.commonpath([root, path]) != root:
+                raise ValueError(f"Not writing {name!r}, it resolves outside the destination")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as output:
+                shutil.copyfileobj(file, output)
+        elif self.mode == 'zip':
+            with self.archive.open(name, 'w', force_zip64=True) as output:
+                shutil.copyfileobj(file, output)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = time.time()
+            self.archive.addfile(info, file)
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
+
+
+def find_index(members):
+    # The shallowest index.html is the space's; its folder is the export root
+    candidates = [member for member in members
+                  if posixpath.basename(member[0]) == 'index.html']
+    if not candidates:
+        raise ValueError("No index.html in the archive")
+    return min(candidates, key=lambda member: member[0].count('/'))
+
+
+def convert_archive(archive_path, destination, title=None, n_workers=None,
+                    parser=None, profile=None):
+    # Converts a zip or tar space export without extracting it. index.html is
+    # read and parsed first; the other members are then read once, in archive
+    # order, pages going to the converter and assets straight to the output.
+    # The destination is a folder, or an archive when it ends in one of
+    # archive_formats.
+    n_workers = n_workers or md_converter.workers
+    parser = resolve_parser(parser or md_converter.html_parser)
+    reader = ArchiveReader(archive_path)
+    safe_members = []
+    for name, size, info in reader.members:
+        path = member_path(name)
+        if path is None:
+            logging.warning(f"Skipping archive member {name!r}, it is outside the export")
+        else:
+            safe_members.append((path, size, info))
+    index_name, _, index_info = find_index(safe_members)
+    root = posixpath.dirname(index_name)
+    title = title or posixpath.basename(root) or \
+        os.path.basename(archive_path).split('.')[0]
+
+    model = index_model(reader.read(index_info), parser)
+    table = dict(model['table'])
+    toc_tree = create_toc_tree([dict(item) for item in model['toc_structure']])
+    toc_index = build_toctree_index(toc_tree)
+
+    members = []
+    for name, size, info in safe_members:
+        relative_path = posixpath.relpath(name, root) if root else name
+        if not relative_path.startswith('../'):
+            members.append((relative_path, size, info))
+    assets = AssetIndex.from_paths(archive_path, [member[0] for member in members])
+    noise = space_noise(title)
+    cache = ConversionCache(md_converter.conversion_cache, md_converter.conversion_cache_size,
+                            cache_context(table, parser, assets, noise)) \
+        if md_converter.conversion_cache else None
+    profiler = ConversionProfiler() if profile else None
+
+    output = OutputWriter(destination)
+    output.write('index.rst', index_rst_text(toc_tree, title))
+
+    pages = {member[0]: member[1] for member in members if member[0].endswith('.html')}
+    progress = ProgressReporter(len(pages), md_converter.metrics_file)
+    n_errors = 0
+    assets_copied = [0, 0]
+
+    def record(relative_path, name, markdown, error, seconds=None):
+        nonlocal n_errors
+        bytes_out = 0
+        if error is None and markdown is not None:
+            data = markdown.encode('utf-8')
+            try:
+                output.copy(name, io.BytesIO(data), len(data))
+                bytes_out = len(data)
+            except (OSError, ValueError) as e:
+                error = str(e)
+        if error is not None:
+            logging.error(f"\033[91m An error occurred in {relative_path}: {error} \033[0m")
+            n_errors += 1
+        progress.update(posixpath.basename(relative_path), error, seconds,
+                        pages[relative_path] if error is None else 0, bytes_out)
+
+    def stream_page(relative_path, info):
+        # Pages too large to hold as a tree are streamed from the member
+        from md_stream_converter import StreamingMarkdownConverter
+        file_name = posixpath.basename(relative_path)
+        with reader.open(info) as member:
+            markdown = StreamingMarkdownConverter(table, None, assets, noise).convert(
+                io.TextIOWrapper(member, encoding='utf-8'))
+        if file_name in table:
+            markdown += toctree_fragment(toc_index, table[file_name])
+        return replace_filename(file_name, table), markdown
+
+    worker_args = ([(table, toc_index, assets, cache, None, None, noise)], parser, bool(profile))
+    executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                   initargs=worker_args) if n_workers > 1 else None
+    if executor is None:
+        _init_worker(*worker_args)
+    in_flight = {}
+
+    def collect(futures):
+        for future in futures:
+            relative_path = in_flight.pop(future)
+            name, markdown, _, error, report = future.result()
+            merge_report(report, profiler, cache)
+            record(relative_path, name, markdown, error, report['seconds'])
+
+    try:
+        for relative_path, size, info in members:
+            if not relative_path.endswith('.html'):
+                if is_asset(posixpath.basename(relative_path)):
+                    try:
+                        with reader.open(info) as member:
+                            output.copy(relative_path, member, size)
+                    except (OSError, ValueError) as e:
+                        logging.error(
+                            f"\033[91m An error occurred in {relative_path}: {e} \033[0m")
+                        n_errors += 1
+                        continue
+                    assets_copied[0] += 1
+                    assets_copied[1] += size
+                continue
+            try:
+                if md_converter.stream_pages_over is not None and \
+                        size > md_converter.stream_pages_over:
+                    start = time.perf_counter()
+                    name, markdown = stream_page(relative_path, info)
+                    record(relative_path, name, markdown, None, time.perf_counter() - start)
+                    continue
+                html = reader.read(info).decode('utf-8')
+            except Exception as e:
+                record(relative_path, None, None, str(e))
+                continue
+            task = (0, relative_path)
+            if executor is None:
+                name, markdown, _, error, report = _convert_page_task(task, html)
+                merge_report(report, profiler, cache)
+                record(relative_path, name, markdown, error, report['seconds'])
+                continue
+            # At most a few pages per worker are held in memory at once
+            in_flight[executor.submit(_convert_page_task, task, html)] = relative_path
+            progress.queue_depth = len(in_flight)
+            if len(in_flight) >= n_workers * 4:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(in_flight))
+    finally:
+        if executor:
+            executor.shutdown()
+    progress.queue_depth = None
+    progress.close()
+
+    output.close()
+    reader.close()
+
+    print(f"\nAssets: {assets_copied[0]} copied ({assets_copied[1] / 1e6:.1f} MB)")
+    if cache:
+        cache.evict()
+        print(f"Conversion cache: {cache.summary()}")
+    if profiler:
+        profiler.save(profile)
+        print(f"Profile written to {profile}")
+
+    if n_errors == 0:
+        print(
+            f"HTML to Markdown conversion completed.\n\033[92m{n_errors} Errors.")
+    else:
+        print(
+            f"HTML to Markdown conversion completed.\n\033[91m{n_errors} Errors.")
@@ -1,28 +1,387 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, CData, NavigableString, Tag
+from bs4.builder import HTMLTreeBuilder
 import re
 
 import os
 import shutil
 
 import logging
+import hashlib
+import io
+import json
+import pickle
+import posixpath
 
 import urllib.parse
+import functools
+from html import unescape as unescape_html
+
+from html_parsers import resolve_parser
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import asyncio
+import time
+import sys
+import bisect
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; reflinks are skipped there
+    pass
 
 source_folder = '/home/guillermo/Portal/py/md_converter/test1/ARTPLATSWS'
 destination_folder = '/home/guillermo/Portal/py/md_converter/test1/source/ARTPLATSWS'
 index_file = '/home/guillermo/Portal/py/md_converter/test1/ARTPLATSWS/index.html'
 toctree_rst_file = '/home/guillermo/Portal/py/md_converter/test1/source/ARTPLATSWS/index.rst'
 index_rst = '/home/guillermo/Portal/py/md_converter/test1/source/ARTPLATSWS/index.rst'
+# Title of the generated index.rst
+space_name = 'ARTPLATSWS'
 allowed_formats = ['.jpg', '.jpeg', '.png', '.gif', '.svg', '.log', '.yaml', '.eml']
+# Number of worker processes used by run_conversion (1 converts serially)
+workers = os.cpu_count() or 1
+# Records what each output was built from, for incremental runs
+manifest_file = '.manifest.json'
+# HTML parser backend: 'html.parser', 'lxml', 'html5lib' or 'auto' for the
+# fastest one installed
+html_parser = 'html.parser'
+# Pages larger than this many bytes are converted with the streaming
+# converter instead of a full tree (None disables it)
+stream_pages_over = 16 * 1024 * 1024
+# Parsed index.html models are kept here between runs
+cache_folder = os.path.join(os.path.expanduser('~'), '.cache', 'md_converter')
+# Bump when build_index changes what it produces
+index_cache_version = 1
+# Parsed index.html models kept in cache_folder and in memory; the least
+# recently used ones beyond this are removed
+index_cache_entries = 16
+# Keep the asset index in cache_folder between runs
+persist_asset_index = True
+# Threads copying assets while pages are converted
+asset_threads = 8
+# Hardlink assets to their source when both are on one filesystem. The
+# destination then shares the file with the export, so leave this off if
+# anything edits the copied assets in place.
+hardlink_assets = True
+# Overlap reading, converting and writing pages with an asyncio pipeline,
+# for exports on slow or network storage
+async_pipeline = False
+# Pages read ahead of conversion, and converted pages waiting to be written
+pipeline_queue_size = 32
+# Threads reading and writing pages in the pipeline
+pipeline_io_threads = 8
+# Folder of the conversion cache shared by runs, spaces and machines (None
+# disables it), and the size its least recently used entries are evicted to
+conversion_cache = None
+conversion_cache_size = 1024 * 1024 * 1024
+# Temporary cache files older than this many seconds were left behind by a
+# writer that crashed, and are removed by evict()
+stale_cache_files = 3600
+# Page regions left out of the Markdown, as simple selectors (tag, #id,
+# .class, tag#id or tag.class). NoiseFilter cuts them from the HTML before
+# parsing when it can; check_converters.py noise checks that this converts
+# like removing them from the parsed tree.
+noise_selectors = ['div#breadcrumb-section', 'div.pageSection',
+                   'div.plugin_attachments_container', 'div#footer', 'ul.toc-indentation']
+# Further noise selectors for particular spaces, by space name
+space_noise_selectors = {}
+# Bump when a converter change alters the Markdown, so cached pages from
+# older versions are not reused
+converter_version = 4
+# Seconds between checks of the source folders in watch mode
+watch_interval = 0.5
+# Seconds between progress lines on a terminal, and in logs otherwise
+progress_interval = 0.5
+log_progress_interval = 10
+# Run metrics are written here while converting: Prometheus text format
+# when the name ends in .prom, otherwise JSON lines (None disables them)
+metrics_file = None
+# Upper bounds, in seconds, of the per-page latency histogram buckets
+latency_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+blank_lines = re.compile(r'\n\n+')
+spaces = re.compile(r' +')
+# Links starting with one of these are left as plain text
+invalid_url_prefixes = ('.', '/', '(', '[', 'rest/')
+# Distinct hrefs whose normalized form is kept by convert_to_valid_url
+url_cache_size = 8192
+
+# Markdown markers for the inline tags rendered inside paragraphs and cells
+inline_markers = {'em': '*', 'strong': '**', 's': '~~'}
+# Tags the paragraph renderer already emits, skipped by walk inside a <p>
+inline_tags = ('a', 'img', 'em', 'strong')
+# Converter methods timed by ConversionProfiler
+profiled_handlers = ('handle_heading', 'handle_paragraph', 'handle_emphasis',
+                     'handle_strong', 'handle_link', 'handle_image', 'handle_list',
+                     'handle_table', 'process_cell', 'render_inline')
+block_tags = ('p', 'div', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+heading_tags = ('h1', 'h2', 'h3')
+# Tags render_list takes out of an item's inline text, and what it leaves there
+list_item_tags = ('ul', 'ol', 'li', 'table') + heading_tags
+list_placeholder = '\x00'
+# Markup whose text may look like tags: comments, scripts and styles
+skipped_markup = r'<!--.*?-->|<(?:script|style)\b.*?</(?:script|style)\s*>'
+# Attributes of a start tag; quoted values may contain '>'
+tag_attributes = r'(?:[^>"\']|"[^"]*"|\'[^\']*\')*'
+# Tags html.parser's tree builder never leaves open
+empty_element_tags = HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS
+attribute = re.compile(r'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+)))?')
+
+
+class MarkdownWriter:
+    # Accumulates converter output in chunks and normalizes it as it goes,
+    # producing the same text as re.sub(r'\n\n+', '\n\n', markdown.strip())
+    # without ever building the whole page as one growing string. Trailing
+    # whitespace is held back until we know whether more text follows it.
+    def __init__(self, file=None):
+        self.file = file
+        self.chunks = []
+        self.pending = ''
+        self.started = False
+        self.size = 0
+
+    def write(self, text):
+        text = self.pending + text
+        body = text.rstrip()
+        if not body:
+            # Leading whitespace of the page is dropped
+            self.pending = text if self.started else ''
+            return
+        self.pending = text[len(body):]
+        if not self.started:
+            body = body.lstrip()
+            self.started = True
+        body = blank_lines.sub('\n\n', body)
+        self.size += len(body)
+        if self.file is None:
+            self.chunks.append(body)
+        else:
+            self.file.write(body)
+
+    def close(self):
+        self.pending = ''
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class ConversionProfiler:
+    # Opt-in instrumentation: records calls, cumulative wall time and
+    # characters written per converter handler, and parse and total time
+    # per page. Converters created without a profiler are not wrapped at
+    # all, so the disabled case costs nothing.
+    def __init__(self):
+        self.handlers = {}
+        self.pages = []
+
+    def instrument(self, converter):
+        converter.written = 0
+        write = converter.write
+
+        def counting_write(text):
+            converter.written += len(text)
+            write(text)
+
+        converter.write = counting_write
+        for name in profiled_handlers:
+            setattr(converter, name, self.wrap(converter, name, getattr(converter, name)))
+
+    def wrap(self, converter, name, method):
+        stats = self.handlers.setdefault(name, [0, 0.0, 0])
+
+        def profiled(*args):
+            written = converter.written
+            start = time.perf_counter()
+            result = method(*args)
+            stats[1] += time.perf_counter() - start
+            stats[0] += 1
+            stats[2] += converter.written - written
+            if isinstance(result, str):
+                stats[2] += len(result)
+            return result
+
+        return profiled
+
+    def add_page(self, page, total, parse, bytes_in, chars_out):
+        self.pages.append({'page': page, 'total_s': total, 'parse_s': parse,
+                           'bytes_in': bytes_in, 'chars_out': chars_out})
+
+    def merge(self, other):
+        for name, (calls, seconds, chars) in other['handlers'].items():
+            stats = self.handlers.setdefault(name, [0, 0.0, 0])
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] += chars
+        self.pages.extend(other['pages'])
+
+    def snapshot(self):
+        return {'handlers': self.handlers, 'pages': self.pages}
+
+    def report(self, top=20):
+        handlers = sorted(self.handlers.items(), key=lambda item: item[1][1], reverse=True)
+        return {
+            'pages': len(self.pages),
+            'total_s': sum(page['total_s'] for page in self.pages),
+            'parse_s': sum(page['parse_s'] or 0 for page in self.pages),
+            'hottest_handlers': [
+                {'handler': name, 'calls': calls, 'cumulative_s': seconds, 'chars_out': chars}
+                for name, (calls, seconds, chars) in handlers],
+            'slowest_pages': sorted(self.pages, key=lambda page: page['total_s'],
+                                    reverse=True)[:top],
+        }
+
+    def save(self, path, top=20):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(top), file, indent=2)
+
+
+class NoiseFilter:
+    # Page regions dropped before conversion, given as simple selectors:
+    # tag, #id, .class, tag#id or tag.class. With html.parser, strip() cuts
+    # the regions out of the HTML text so they are never parsed; when a
+    # region's end cannot be told from the text alone the page is parsed
+    # whole and the regions are removed from the tree instead. lxml and
+    # html5lib repair misnested markup in their own ways, so with them the
+    # regions are always removed from the tree.
+    def __init__(self, selectors):
+        self.selectors = tuple(selectors)
+        self.rules = [parse_selector(selector) for selector in self.selectors]
+        tags = {tag for tag, _, _ in self.rules}
+        names = '|'.join(sorted(tags)) if None not in tags else r'[a-zA-Z][\w:-]*'
+        self.start = re.compile(skipped_markup + r'|<(' + names + r')(?=[\s/>])(' + tag_attributes + r')>',
+                                re.I | re.S)
+        self.tags = re.compile(skipped_markup + r'|<(/?)([a-zA-Z][\w:-]*)(?=[\s/>])(' +
+                               tag_attributes + r')>', re.I | re.S)
+
+    def matches(self, tag, attrs):
+        for rule_tag, kind, value in self.rules:
+            if rule_tag is not None and rule_tag != tag:
+                continue
+            if kind == '#' and attrs.get('id') != value:
+                continue
+            if kind == '.' and value not in (attrs.get('class') or '').split():
+                continue
+            return True
+        return False
+
+    def strip(self, html):
+        # The HTML without the noise regions, or None if they cannot be cut
+        if not self.rules:
+            return html
+        if not isinstance(html, str):
+            return None
+        parts = []
+        position = 0
+        for match in self.start.finditer(html):
+            if match.group(1) is None or match.start() < position:
+                continue
+            tag = match.group(1).lower()
+            if not self.matches(tag, parse_attributes(match.group(2))):
+                continue
+            end = match.end() if match.group(2).endswith('/') else \
+                self.region_end(html, tag, match.end())
+            if end is None:
+                return None
+            parts.append(html[position:match.start()])
+            position = end
+        if not parts:
+            return html
+        parts.append(html[position:])
+        # An empty comment keeps the text on either side of a region apart,
+        # as in the tree the region is removed from; the parser would merge
+        # whitespace-only text into one newline
+        return '<!---->'.join(parts)
+
+    def region_end(self, html, tag, position):
+        # End of the element whose start tag ends at position, following
+        # html.parser's tree builder: an end tag closes the innermost open
+        # element of its name, and the region's own end tag closes whatever
+        # is still open in it. An end tag for an element opened before the
+        # region would close it early, so the region is not cut then.
+        open_tags = []
+        for match in self.tags.finditer(html, position):
+            if match.group(1) is None:
+                continue
+            name = match.group(2).lower()
+            if not match.group(1):
+                if name not in empty_element_tags and not match.group(3).endswith('/'):
+                    open_tags.append(name)
+            elif name in open_tags:
+                del open_tags[len(open_tags) - 1 - open_tags[::-1].index(name):]
+            elif name == tag:
+                return match.end()
+            else:
+                return None
+        return None
+
+    def decompose(self, soup):
+        if not self.rules:
+            return
+        for tag in soup.select(', '.join(self.selectors)):
+            if not tag.decomposed:
+                tag.decompose()
+
+
+def parse_selector(selector):
+    match = re.fullmatch(r'([a-zA-Z][\w-]*)?(?:([#.])([\w-]+))?', selector.strip())
+    if not selector.strip() or match is None:
+        raise ValueError(f"Unsupported noise selector: {selector!r}")
+    tag, kind, value = match.groups()
+    return tag and tag.lower(), kind, value
+
+
+def parse_attributes(text):
+    return {name.lower(): unescape_html(double or single or bare)
+            for name, double, single, bare in attribute.findall(text)}
+
+
+@functools.lru_cache()
+def noise_filter(selectors):
+    return NoiseFilter(selectors)
+
+
+def space_noise(name=None):
+    # noise_selectors plus the space's own space_noise_selectors
+    return noise_filter(tuple(noise_selectors) + tuple(space_noise_selectors.get(name, ())))
 
 
 class HTMLToMarkdownConverter:
-    def __init__(self, table):
-        self.markdown = ""
+    def __init__(self, table, parser='html.parser', assets=None, profiler=None, noise=None):
+        self.output = MarkdownWriter()
         self.has_title = False
         self.count = 0
         self.processed_links = []
         self.table = table
+        self.parser = parser
+        self.assets = assets
+        self.profiler = profiler
+        self.noise = noise or space_noise()
+        self.parse_time = None
+        # Rewritten link and image URLs, recorded so that incremental runs
+        # can tell whether a new index.html changes this page
+        self.links = {}
+        self.images = {}
+        # Whether the last line of a list is a marker without text. An item
+        # can start with one blank line only, so what follows it in the item
+        # comes right below it.
+        self.empty_marker = False
+        if profiler:
+            profiler.instrument(self)
+        self.handlers = {
+            'h1': self.handle_heading,
+            'h2': self.handle_heading,
+            'h3': self.handle_heading,
+            'p': self.handle_paragraph,
+            'em': self.handle_emphasis,
+            'strong': self.handle_strong,
+            'a': self.handle_link,
+            'img': self.handle_image,
+        }
+
+    def write(self, text):
+        self.output.write(text)
 
     def handle_heading(self, tag):
         level = int(tag.name[1])
@@ -33,11 +392,11 @@ class HTMLToMarkdownConverter:
             match = re.search(r'[^:]+:\s(.*?)$', title)
             if match:
                 title = match.group(1)
-            self.markdown += f"\n\n{'#' * level} {title}\n\n"
+            self.write(f"\n\n{'#' * level} {title}\n\n")
         elif self.has_title:
-            self.markdown += f"\n\n{'#' * (level + 1)} {tag.get_text().strip()}\n\n"
+            self.write(f"\n\n{'#' * (level + 1)} {tag.get_text().strip()}\n\n")
         else:
-            self.markdown += f"\n\n{'#' * level} {tag.get_text().strip()}\n\n"
+            self.write(f"\n\n{'#' * level} {tag.get_text().strip()}\n\n")
 
     def handle_paragraph(self, tag):
         if tag.get_text().strip() == 'TOC':
@@ -45,136 +404,182 @@ class HTMLToMarkdownConverter:
         elif tag.has_attr('style'):
             tag['style'] == ''
         else:
-            link_tags = tag.find_all("a")
-            img_tags = tag.find_all("img")
-            processed_text = tag.get_text().strip()
-
-            for link_tag in link_tags:
-                link_href = link_tag.get('href')
-                link_text = link_tag.get_text() or 'link'
-                if self.check_url(link_href):
-                    link = f"[{link_text.strip()}]({replace_filename(link_href.strip(), self.table)}) "
-                    if not link in processed_text:
-                        self.processed_links.append(link)
-                        processed_text = processed_text.replace(
-                            link_text, link)
-
-            for img_tag in img_tags:
-                src = img_tag.get("src", "")
-                alt_text = img_tag.get("alt", "Image").strip() or src
-                img = f" ![{alt_text}]({parse_image_url(src)}) "
-                if self.check_url(src) and not '/thumbnail/' in src:
-                    if not img in processed_text:
-                        self.processed_links.append(img)
-                        processed_text += img
-
-            processed_text = re.sub(r' +', ' ', processed_text)
-            processed_text = re.sub(r'\n\n+', '\n\n', processed_text)
-            self.markdown += f"\n{processed_text}\n\n"
+            processed_text = self.render_inline(tag).strip()
+            processed_text = spaces.sub(' ', processed_text)
+            processed_text = blank_lines.sub('\n\n', processed_text)
+            self.write(f"\n{processed_text}\n\n")
 
     def handle_emphasis(self, tag):
-        self.markdown += f"*{tag.get_text().strip()}* "
+        self.write(f"*{tag.get_text().strip()}* ")
 
     def handle_strong(self, tag):
         text = tag.get_text().strip()
         if text:
-            self.markdown += f"**{tag.get_text().strip()}** "
+            self.write(f"**{tag.get_text().strip()}** ")
 
     def handle_link(self, tag):
         link_href = tag.get('href')
         link_text = tag.get_text() or 'link'
         if self.check_url(link_href):
-            link = f"[{link_text.strip()}]({replace_filename(link_href.strip(), self.table)}) "
+            link = f"[{link_text.strip()}]({self.link_target(link_href.strip())}) "
             self.processed_links.append(link)
-            self.markdown += link
+            self.write(link)
 
     def handle_image(self, tag):
         alt_text = tag.get("alt", "Image")
         src = tag.get("src", "")
         if self.check_url(src) and not '/thumbnail/' in src:
-            self.markdown += f"![{alt_text.strip()}]({parse_image_url(src)}) "
+            self.write(f"![{alt_text.strip()}]({self.image_url(src)}) ")
 
     def handle_list(self, tag):
-        list_items = [li.get_text() for li in tag.find_all("li")]
-        for item in list_items:
-            self.markdown += f"  - {item.strip()}\n"
+        # A list starts on a line of its own, also after text written
+        # outside of a paragraph
+        self.write('\n\n')
+        self.empty_marker = False
+        self.render_list(tag, 2)
+        self.write('\n')
+
+    def render_list(self, tag, indent):
+        # Renders the items of a list with their inline formatting, and the
+        # lists nested in them indented to the item text, visiting each tag
+        # once. Ordered lists are numbered from their start attribute.
+        start = tag.get('start', '')
+        state = {'ordered': tag.name == 'ol', 'content': indent, 'first': True,
+                 'number': int(start) if tag.name == 'ol' and start.isdigit() else 1}
+        nested = []
+        self.render_inline(tag, nested)
+        for child in nested:
+            if child.name == 'li':
+                self.render_item(child, indent, state)
+            else:
+                # A list directly in a list belongs to the item before it
+                self.render_nested(child, state)
+
+    def render_item(self, tag, indent, state):
+        nested = []
+        segments = self.render_inline(tag, nested).split(list_placeholder)
+        text = item_text(segments[0])
+        if text or any(child.name != 'li' for child in nested):
+            marker = f"{state['number']}." if state['ordered'] else '-'
+            # Only a first item with text, numbered 1 if ordered, can start
+            # a list right below a line of text
+            if state.pop('first', False) and (not text or state['number'] != 1) and \
+                    not self.empty_marker:
+                self.write('\n')
+            state['number'] += 1
+            state['content'] = indent + len(marker) + 1
+            self.empty_marker = not text
+            self.write(f"{' ' * indent}{marker} {text}".rstrip() + '\n')
+        for child, text in zip(nested, segments[1:]):
+            if child.name == 'li':
+                # An item the markup left open ends where the next one starts
+                self.render_item(child, indent, state)
+            else:
+                self.render_nested(child, state)
+            # Text after a nested list, table or heading continues the item,
+            # as a paragraph of its own so it is not taken into a nested item
+            text = item_text(text)
+            if text:
+                blank = '' if self.empty_marker else '\n'
+                self.write(f"{blank}{' ' * state['content']}{text}\n")
+                self.empty_marker = False
+
+    def render_nested(self, tag, state):
+        # Tables and headings in an item are written after its line,
+        # indented to its text so the list goes on after them
+        if tag.name == 'table' or tag.name in heading_tags:
+            output, self.output = self.output, io.StringIO()
+            try:
+                if tag.name == 'table':
+                    self.handle_table(tag)
+                else:
+                    self.handle_heading(tag)
+            finally:
+                output, self.output = self.output, output
+            text = output.getvalue()
+            if text:
+                if self.empty_marker:
+                    text = text.lstrip('\n')
+                self.empty_marker = False
+                self.write(indent_lines(text, state['content']))
+        else:
+            self.render_list(tag, state['content'])
+
+    def link_target(self, href):
+        self.links[href] = target = resolve_link(href, self.table, self.assets)
+        return target
+
+    def image_url(self, src):
+        self.images[src] = url = resolve_image(src, self.assets)
+        return url
 
     def check_url(self, url):
-        if not url or url.strip() == '' or url.strip() == '#':
+        if not url:
             return False
-        invalid_url = ['.', '/', '(', '[', 'rest/']
-        for invalid in invalid_url:
-            if url.strip().startswith(invalid):
-                return False
-        return True
+        url = url.strip()
+        return url != '' and url != '#' and not url.startswith(invalid_url_prefixes)
+
+    def render_inline(self, root, lists=None):
+        # Walk the children of a paragraph or table cell once and emit
+        # Markdown for links, images and emphasis where they occur. With a
+        # lists list, list items, nested lists, tables and headings are not
+        # rendered but appended to it, leaving list_placeholder in the text.
+        parts = []
+        # A link around an image, another link or a taken out tag is left
+        # out and its contents rendered
+        link_contents = ['img', 'a'] + (list(list_item_tags) if lists is not None else [])
+        stack = [(iter(root.contents), None, parts)]
+        while stack:
+            children, wrapper, parts = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if wrapper == '\n':
+                    parts.append(wrapper)
+                elif wrapper:
+                    # Text on either side of a taken out tag is wrapped on its own
+                    stack[-1][2].append(list_placeholder.join(
+                        wrap_text(text, wrapper) if text.strip() else text
+                        for text in ''.join(parts).split(list_placeholder)))
+                continue
+            if not isinstance(child, Tag):
+                if type(child) in (NavigableString, CData):
+                    parts.append(child)
+            elif lists is not None and child.name in list_item_tags:
+                lists.append(child)
+                parts.append(list_placeholder)
+            elif child.name == 'a':
+                link_href = child.get('href')
+                if self.check_url(link_href) and not child.find(link_contents):
+                    link_text = child.get_text().strip() or 'link'
+                    link = f"[{link_text}]({self.link_target(link_href.strip())}) "
+                    self.processed_links.append(link)
+                    parts.append(link)
+                else:
+                    stack.append((iter(child.contents), None, parts))
+            elif child.name == 'img':
+                src = child.get("src", "")
+                if self.check_url(src) and not '/thumbnail/' in src:
+                    alt_text = child.get("alt", "Image").strip() or src
+                    img = f" ![{alt_text}]({self.image_url(src)}) "
+                    self.processed_links.append(img)
+                    parts.append(img)
+            elif child.name == 'code':
+                text = child.get_text()
+                parts.append(wrap_text(text, '`') if text.strip() else text)
+            elif child.name == 'br':
+                parts.append('\n')
+            elif child.name in inline_markers:
+                stack.append((iter(child.contents), inline_markers[child.name], []))
+            elif child.name in block_tags:
+                # Blocks nested in a cell or paragraph end with a line break
+                stack.append((iter(child.contents), '\n', parts))
+            else:
+                stack.append((iter(child.contents), None, parts))
+        return ''.join(parts)
 
     def process_cell(self, tag):
-        processed_text = tag.get_text()
-        link_tags = tag.find_all("a")
-        img_tags = tag.find_all("img")
-        em_tags = tag.find_all("em")
-        stron_tags = tag.find_all("strong")
-        overlined = tag.find_all("s")
-        code_tags = tag.find_all("code")
-
-        for link_tag in link_tags:
-            if not link_tag.find_all('img') and not link_tag.find_all('a'):
-                link_href = link_tag.get('href')
-                link_text = link_tag.get_text() or 'link'
-                if self.check_url(link_href):
-                    link = f"[{link_text.strip()}]({replace_filename(link_href.strip(), self.table)}) "
-                    if not link in processed_text:
-                        self.processed_links.append(link)
-                        processed_text = processed_text.replace(
-                            link_text, link)
-
-        for img_tag in img_tags:
-            src = img_tag.get("src", "")
-            alt_text = img_tag.get("alt", "Image") or src
-            img = f"![{alt_text}]({parse_image_url(src)}) "
-            if self.check_url(src) and not '/thumbnail/' in src:
-
-                if img_tag.parent:
-                    parent = img_tag.parent.get_text().strip()
-                    html = str(img_tag.parent).replace(str(img_tag), img)
-                    soup = BeautifulSoup(html, "html.parser")
-                    soup_text = soup.get_text().strip()
-                    if soup_text not in processed_text:
-                        self.processed_links.append(img)
-                        start = processed_text.find(parent)
-                        end = start + len(parent)
-                        processed_text = processed_text[:start] + \
-                            soup_text + processed_text[end:]
-
-        for em_tag in em_tags:
-            text = em_tag.get_text()
-            em_text = f"*{text}*"
-            if text and not em_text in processed_text:
-                processed_text = processed_text.replace(text, em_text)
-
-        for strong_tag in stron_tags:
-            text = strong_tag.get_text()
-            strong_text = f"**{text}** "
-            if text:
-                if not strong_text in processed_text:
-                    processed_text = processed_text.replace(text, strong_text)
-
-        for overline in overlined:
-            text = overline.get_text()
-            for link in self.processed_links:
-                if text == link:
-                    continue
-            overlined_text = f"~~{text}~~ "
-            if text and not overlined_text in processed_text:
-                processed_text = processed_text.replace(text, overlined_text)
-
-        for code in code_tags:
-            text = code.get_text()
-            code_text = f"`{text}` "
-            if text:
-                if not code_text in processed_text:
-                    processed_text = processed_text.replace(text, code_text)
-
+        processed_text = self.render_inline(tag)
         processed_text = clean_text(processed_text).replace('\n', '<br>')
         processed_text = re.sub(r'(<br>){2,}', '<br><br>', processed_text)
         return processed_text
@@ -186,123 +591,301 @@ class HTMLToMarkdownConverter:
             col_widths = tag.get("data-column-widths", "").split(",")
             header_rows = int(tag.get("data-header-rows", "1"))
 
-            self.markdown += f"\n\n:::{{list-table}} {table_title}\n"
+            self.write(f"\n\n:::{{list-table}} {table_title}\n")
 
             if col_widths and all(width.strip().isdigit() for width in col_widths):
-                self.markdown += f":widths: {' '.join(col_widths)}\n"
-
-            self.markdown += f":header-rows: {header_rows}\n\n"
-            # Find the maximum number of columns in any row
-            max_columns = max(len(row.find_all(["th", "td"])) for row in rows)
-
-            headers = [header.get_text().strip()
-                       for header in rows[0].find_all(["th", "td"])]
-            headers = [header.replace('\n', ' <br> ').replace(
-                '-', ' ').strip() for header in headers]
+                self.write(f":widths: {' '.join(col_widths)}\n")
 
-            # Add empty headers for any missing columns
-            while len(headers) < max_columns:
-                headers.append("")
+            self.write(f":header-rows: {header_rows}\n\n")
+            # Lay out the cells of every row once, with spanned columns
+            # filled in, to find the maximum number of columns in any row
+            grid = table_grid(rows)
+            max_columns = max(len(cells) for cells in grid)
 
             if len(rows) < 2:
-                processed_headers = [self.process_cell(
-                    header) for header in rows[0].find_all(["th", "td"])]
-                self.markdown += "*   - " + \
-                    "\n    - ".join(processed_headers) + "\n"
+                processed_headers = [self.process_cell(header) if header else ""
+                                     for header in grid[0]]
+                self.write("*   - " + "\n    - ".join(processed_headers) + "\n")
                 for i, _ in enumerate(processed_headers):
                     if i == 0:
-                        self.markdown += "*   - " + "\n"
+                        self.write("*   - " + "\n")
                     else:
-                        self.markdown += "    - " + "\n"
+                        self.write("    - " + "\n")
 
             else:
-                self.markdown += "*   - " + "\n    - ".join(headers) + "\n"
-                for row in rows[1:]:
-                    cells = [self.process_cell(cell)
-                             for cell in row.find_all(["th", "td"])]
+                headers = [header_text(header.get_text()) if header else ""
+                           for header in grid[0]]
+
+                # Add empty headers for any missing columns
+                while len(headers) < max_columns:
+                    headers.append("")
+
+                self.write("*   - " + "\n    - ".join(headers) + "\n")
+                for cells in grid[1:]:
+                    cells = [self.process_cell(cell) if cell else ""
+                             for cell in cells]
 
                     # Add empty cells for any missing columns
                     while len(cells) < max_columns:
                         cells.append("")
 
-                    self.markdown += "*   - " + "\n    - ".join(cells) + "\n"
+                    self.write("*   - " + "\n    - ".join(cells) + "\n")
 
-            self.markdown += ":::\n\n"
+            self.write(":::\n\n")
 
-    def convert(self, html):
-        soup = BeautifulSoup(html, "html.parser")
+    def walk(self, root):
+        # Visit every tag once in document order, carrying down whether we
+        # are inside a paragraph instead of looking up the parents of each tag
+        stack = [(child, False) for child in reversed(root.contents)
+                 if isinstance(child, Tag)]
+        while stack:
+            tag, in_paragraph = stack.pop()
+            if tag.name == 'table':
+                # Table contents are rendered by handle_table only
+                self.handle_table(tag)
+                continue
+            if tag.name in ('ul', 'ol'):
+                # Nested lists are rendered by handle_list with their parent
+                self.handle_list(tag)
+                continue
+            if not (in_paragraph and tag.name in inline_tags):
+                handler = self.handlers.get(tag.name)
+                if handler:
+                    handler(tag)
+            in_paragraph = in_paragraph or tag.name == 'p'
+            stack.extend((child, in_paragraph) for child in reversed(tag.contents)
+                         if isinstance(child, Tag))
+
+    def convert(self, html, file=None):
+        # With a file the Markdown is streamed into it and None is returned.
+        # A converter can be reused for any number of pages.
+        self.output = MarkdownWriter(file)
+        self.has_title = False
+        self.count = 0
+        self.processed_links = []
+        self.links = {}
+        self.images = {}
+        if self.profiler:
+            start = time.perf_counter()
+        # Remove unwanted sections, before parsing when possible
+        stripped = self.noise.strip(html) if self.parser == 'html.parser' else None
+        soup = BeautifulSoup(html if stripped is None else stripped, self.parser)
+        if stripped is None:
+            self.noise.decompose(soup)
 
-        # Remove unwanted sections
-        breadcrumb = soup.find('div', id="breadcrumb-section")
-        if (breadcrumb):
-            breadcrumb.decompose()
-        page_sections = soup.find_all("div", {"class": "pageSection"})
-        attachments = soup.find_all(
-            "div", {"class": "plugin_attachments_container"})
-        if (page_sections):
-            for div in page_sections:
-                div.decompose()
-        if (attachments):
-            for div in attachments:
-                div.decompose()
+        if self.profiler:
+            self.parse_time = time.perf_counter() - start
+        self.walk(soup)
 
-        footer = soup.find('div', id="footer")
-        if (footer):
-            footer.decompose()
+        self.output.close()
+        return None if file else self.output.getvalue()
 
-        for tag in soup.find_all("ul", {'class': 'toc-indentation'}):
-            tag.decompose()
 
-        for tag in soup.find_all():
-            if tag.find_parent("table"):
-                continue  # Skip processing tags within tables
-            if tag.name == "h1" or tag.name == "h2" or tag.name == "h3":
-                self.handle_heading(tag)
-            elif tag.name == "p":
-                self.handle_paragraph(tag)
-            elif tag.name == "em":
-                self.handle_emphasis(tag)
-            elif tag.name == "strong":
-                self.handle_strong(tag)
-            elif tag.name == "a":
-                if tag.find_parent("p"):
-                    continue  # Skip processing links within paragraphs
-                self.handle_link(tag)
-            elif tag.name == "img":
-                if tag.find_parent("p"):
-                    continue  # Skip processing imgs within paragraphs
-                self.handle_image(tag)
-            elif tag.name == "ul" or tag.name == "ol":
-                self.handle_list(tag)
-            elif tag.name == "table":
-                self.handle_table(tag)
+# ----------------- MAIN -------------------
 
-        return re.sub(r'\n\n+', '\n\n', self.markdown.strip())
+def build_index(html, parser='html.parser'):
+    # One parse of index.html gives both the href -> target filename table
+    # and the TOC entries with their nesting depth
+    soup = BeautifulSoup(html, parser)
+    table = {}
+    toc_structure = []
 
+    for link in soup.find_all('a'):
+        url = link.get('href')
+        text = link.get_text() or url
+        if url not in table:
+            table[url] = convert_to_valid_url(text) + '.md'
 
-# ----------------- MAIN -------------------
+        if url is not None and url.endswith('.html'):
+            indentation = sum(1 for parent in link.parents if parent.name == 'ul')
+            toc_structure.append({
+                'text': spaces.sub(' ', link.get_text().replace('\n', ' ')),
+                'link': convert_to_valid_url(link.get_text()),
+                'indentation': indentation,
+            })
+
+    return {'table': table, 'toc_structure': toc_structure}
+
+
+# Index models already loaded by this process, by index cache key
+_index_models = {}
 
-def build_url_table():
-    index_path = '/home/guillermo/Portal/py/md_converter/test1/ARTPLATSWS/index.html'
-    table = {}
 
-    with open(index_path, 'r', encoding='utf-8') as file:
-        html = file.read()
-        soup = BeautifulSoup(html, "html.parser")
-        links = soup.find_all('a')
+def load_index(index_path, parser='html.parser'):
+    with open(index_path, 'rb') as file:
+        return index_model(file.read(), parser)
 
-        for link in links:
-            url = link.get('href')
-            text = link.get_text() or url
-            if url not in table:
-                table[url] = convert_to_valid_url(text) + '.md'
 
-        # print(table)
-        return table
+def index_model(data, parser='html.parser'):
+    # The model of index.html's bytes is cached on disk keyed by their hash,
+    # so later runs and worker processes skip parsing it
+    key = hashlib.sha256(data + parser.encode('utf-8')).hexdigest()
+    key = f"{index_cache_version}-{key}"
+    if key in _index_models:
+        return _index_models[key]
+
+    cache_path = os.path.join(cache_folder, f"index-{key}.pickle")
+    model = load_pickle(cache_path)
+    if isinstance(model, dict) and 'table' in model:
+        try:
+            # Marks the model as recently used for prune_index_cache
+            os.utime(cache_path)
+        except OSError:
+            pass
+    else:
+        model = build_index(data.decode('utf-8'), parser)
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            save_pickle(model, cache_path)
+            prune_index_cache()
+        except OSError as e:
+            logging.warning(f"Could not write index cache {cache_path}: {e}")
+
+    if len(_index_models) >= index_cache_entries:
+        del _index_models[next(iter(_index_models))]
+    _index_models[key] = model
+    return model
+
+
+def prune_index_cache():
+    # Removes all but the index_cache_entries most recently used index
+    # models, and temporary files left behind by runs that crashed
+    models = []
+    stale = time.time() - stale_cache_files
+    with os.scandir(cache_folder) as entries:
+        for entry in entries:
+            if not entry.name.startswith('index-'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+                if entry.name.endswith('.pickle'):
+                    models.append((mtime, entry.path))
+                elif entry.name.endswith('.tmp') and mtime < stale:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    for _, path in sorted(models, reverse=True)[index_cache_entries:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_pickle(path):
+    # None when the file is missing or unreadable; a truncated or corrupted
+    # pickle can raise almost any exception
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except Exception:
+        return None
+
+
+def create_temporary(path):
+    # Opens a new file of its own next to path, to be renamed into place, so
+    # concurrent runs never write into the same file. Unlike mkstemp's 0600
+    # it gets the mode open() gives under the umask, so runs under other
+    # users sharing the folder can read it.
+    while True:
+        temporary = f"{path}.{os.urandom(8).hex()}.tmp"
+        try:
+            return os.open(temporary, os.O_CREAT | os.O_EXCL | os.O_WRONLY |
+                           getattr(os, 'O_BINARY', 0), 0o666), temporary
+        except FileExistsError:
+            continue
+
+
+def save_pickle(value, path):
+    descriptor, temporary = create_temporary(path)
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def build_url_table(parser='html.parser'):
+    return dict(load_index(index_file, parser)['table'])
+
+
+def span_value(value, limit):
+    # colspan and rowspan as browsers read them: invalid or zero values
+    # count as 1 and huge ones are capped
+    try:
+        return min(max(int(value), 1), limit)
+    except (TypeError, ValueError):
+        return 1
+
+
+def place_cell(cells, spans, cell, colspan=1, rowspan=1):
+    # Appends a cell to a row after any columns still covered by a rowspan
+    # from the rows above. spans maps column -> rows it stays covered; the
+    # columns covered by colspan and rowspan are left as "" so later cells
+    # land in the right column.
+    while spans.get(len(cells)):
+        spans[len(cells)] -= 1
+        cells.append("")
+    column = len(cells)
+    cells.append(cell)
+    cells.extend([""] * (colspan - 1))
+    if rowspan > 1:
+        for covered in range(column, column + colspan):
+            spans[covered] = rowspan - 1
+
+
+def end_row(cells, spans):
+    # Fills the columns past the last cell still covered from above
+    last = max((column for column, left in spans.items() if left and column >= len(cells)),
+               default=-1)
+    while len(cells) <= last:
+        if spans.get(len(cells)):
+            spans[len(cells)] -= 1
+        cells.append("")
+
+
+def table_grid(rows):
+    # Cell tags of every row, found with one scan per row, with "" in the
+    # columns that colspan and rowspan cover
+    grid = []
+    spans = {}
+    for row in rows:
+        cells = []
+        for cell in row.find_all(["th", "td"]):
+            place_cell(cells, spans, cell, span_value(cell.get('colspan'), 1000),
+                       span_value(cell.get('rowspan'), 65534))
+        end_row(cells, spans)
+        grid.append(cells)
+    return grid
 
 
 def clean_text(text):
-    return re.sub(r' +', ' ', re.sub(r'\n\n+', '\n\n', text.strip()))
+    return spaces.sub(' ', blank_lines.sub('\n\n', text.strip()))
+
+
+def header_text(text):
+    # A header cell of a table with body rows is rendered from its plain text
+    return text.strip().replace('\n', ' <br> ').replace('-', ' ').strip()
+
+
+def item_text(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def indent_lines(text, indent):
+    # Blank lines are left empty
+    return re.sub(r'^(?=.)', ' ' * indent, text, flags=re.M)
+
+
+def wrap_text(text, marker):
+    # Put the marker around the text but outside its surrounding whitespace
+    stripped = text.strip()
+    start = text.index(stripped)
+    return f"{text[:start]}{marker}{stripped}{marker}{text[start + len(stripped):]}"
 
 
 def parse_image_url(url):
@@ -311,38 +894,33 @@ def parse_image_url(url):
     return url
 
 
-def replace_filename(file_path, table):
-    if file_path in table:
-        return table[file_path]
-    return convert_to_valid_url(file_path)
+def resolve_link(href, table, assets=None):
+    # Links to exported attachments point at the copied file, others
+    # go through the URL table
+    if assets is not None and href not in table:
+        local = assets.resolve(href)
+        if local:
+            return href if local == asset_path(href) else urllib.parse.quote(local)
+    return replace_filename(href, table)
 
 
-def extract_toc_structure(html_file):
-    with open(html_file, 'r', encoding='utf-8') as file:
-        soup = BeautifulSoup(file, 'html.parser')
-
-    def calculate_indentation(tag):
-        indentation = 0
-        parent = tag.find_parent(['ul'])
-        while parent:
-            indentation += 1
-            parent = parent.find_parent(['ul'])
-        return indentation
-
-    toc_structure = []
+def resolve_image(src, assets=None):
+    if assets is not None:
+        local = assets.resolve(src)
+        if local and local != asset_path(src):
+            return urllib.parse.quote(local)
+    return parse_image_url(src)
 
-    for anchor in soup.find_all('a', href=True):
-        link = anchor['href']
-        if link.endswith('.html'):
-            text = re.sub(r' +', ' ', anchor.get_text().replace('\n', ' '))
-            indentation = calculate_indentation(anchor)
 
-            url = convert_to_valid_url(anchor.get_text())
+def replace_filename(file_path, table):
+    if file_path in table:
+        return table[file_path]
+    return convert_to_valid_url(file_path)
 
-            toc_structure.append(
-                {'text': text, 'link': url, 'indentation': indentation})
 
-    return toc_structure
+def extract_toc_structure(html_file, parser='html.parser'):
+    # Copies, since create_toc_tree adds subitems to the entries
+    return [dict(item) for item in load_index(html_file, parser)['toc_structure']]
 
 
 def create_toc_tree(toc_structure):
@@ -367,128 +945,1229 @@ def create_toc_tree(toc_structure):
     return toc_tree
 
 
+# The same hrefs and TOC titles repeat across every page of a space, so the
+# normalized form is memoized; hrefs listed in index.html never get here, as
+# the URL table already holds their target
+@functools.lru_cache(maxsize=url_cache_size)
 def convert_to_valid_url(input_string):
-    url_string = re.sub(
-        r' +', ' ', input_string.replace('\n', ' ')).replace(' ', '_')
+    url_string = spaces.sub(' ', input_string.replace('\n', ' ')).replace(' ', '_')
     url_string = urllib.parse.quote(url_string, safe=":()?&=#*'%").replace('~', '')
     return url_string.replace('.html', '.md')
 
 
-def write_toctree(toc_tree, file, name):
-    page = find_value_recursive(toc_tree, name.replace('.md', ''))
-    if page and 'subitems' in page:
-        file.write("\n\n```{toctree}\n")
-        file.write("   :hidden:\n\n")
+def build_toctree_index(toc_tree):
+    # Map every TOC link to the toctree fragment of its node, built in one
+    # pre-order pass. When a link repeats, the first node in document order
+    # wins.
+    toc_index = {}
+    stack = list(reversed(toc_tree))
+    while stack:
+        page = stack.pop()
+        if page['link'] not in toc_index:
+            fragment = ''
+            if 'subitems' in page:
+                fragment = "\n\n```{toctree}\n" + "   :hidden:\n\n"
+                for item in page['subitems']:
+                    fragment += '   ' + f"{item['text']} <{item['link']}>\n"
+                fragment += "```\n"
+            toc_index[page['link']] = fragment
+        stack.extend(reversed(page.get('subitems', [])))
+    return toc_index
 
-        for item in page['subitems']:
-            file.write('   ' + f"{item['text']} <{item['link']}>\n")
 
-        file.write("```\n")
+def toctree_fragment(toc_index, name):
+    return toc_index.get(name.replace('.md', '')) or ''
 
 
-def write_index_rst(toc_tree, path, title):
+def index_rst_text(toc_tree, title):
     tree = f"{title}\n" + '=' * \
         len(title) + '\n\n' + ".. toctree::\n   :hidden:\n\n"
     for item in toc_tree:
         if 'subitems' in item:
             for subitem in item['subitems']:
                 tree += f'   {subitem["text"]} <{convert_to_valid_url(subitem["link"])}>\n'
-    with open(path, 'w', encoding='utf-8') as file:
-        file.write(tree)
+    return tree
 
 
-def find_value_recursive(data, target_key):
-    if isinstance(data, dict):
-        if 'link' in data and data['link'] == target_key:
-            return data
-        for key, value in data.items():
-            result = find_value_recursive(value, target_key)
-            if result is not None:
-                return result
-    elif isinstance(data, list):
-        for item in data:
-            result = find_value_recursive(item, target_key)
-            if result is not None:
-                return result
-    return None
+def write_index_rst(toc_tree, path, title):
+    tree = index_rst_text(toc_tree, title)
+    # Left alone when unchanged, so a previewing Sphinx does not rebuild
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            if file.read() == tree:
+                return
+    except OSError:
+        pass
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(tree)
 
 
-def check_local_asset(path):
-    # Check if the link path is local and the file exists
-    # If not exists, change the path in order to take the file/page from Confluence
-    local_path = ''
-    with open(path, 'r', encoding='utf-8') as file:
-        if file:
+def is_asset(file_name):
+    # Non-page files that are copied to the destination
+    return any(file_name.endswith(format) for format in allowed_formats) or \
+        (file_name.isdigit() and not '.' in file_name)
+
+
+def asset_path(url):
+    # The source-relative path a link or image URL points to
+    path = urllib.parse.unquote(url.split('#')[0].split('?')[0])
+    while path.startswith('./'):
+        path = path[2:]
+    return path
+
+
+class AssetIndex:
+    # Maps relative path, basename and Confluence attachment id of every
+    # asset under root to its relative path. A refresh stats one entry per
+    # directory and rescans only directories whose mtime changed.
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {}
+        self.by_path = {}
+        self.by_name = {}
+        self.by_id = {}
+        self.resolved = {}
+
+    def __getstate__(self):
+        # Resolved URLs are a per-process memo and are not persisted
+        state = dict(self.__dict__)
+        state['resolved'] = {}
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('resolved', {})
+        self.__dict__.update(state)
+
+    def refresh(self):
+        changed = False
+        seen = set()
+        pending = ['']
+        while pending:
+            relative_dir = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root, relative_dir)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen.add(relative_dir)
+            entry = self.dirs.get(relative_dir)
+            if not entry or entry[0] != mtime:
+                files, subdirs = [], []
+                with os.scandir(os.path.join(self.root, relative_dir)) as entries:
+                    for dir_entry in entries:
+                        if dir_entry.is_dir():
+                            subdirs.append(dir_entry.name)
+                        elif is_asset(dir_entry.name):
+                            files.append(dir_entry.name)
+                entry = self.dirs[relative_dir] = (mtime, sorted(files), sorted(subdirs))
+                changed = True
+            pending.extend(posixpath.join(relative_dir, subdir) for subdir in entry[2])
+
+        for relative_dir in set(self.dirs) - seen:
+            del self.dirs[relative_dir]
+            changed = True
+        if changed:
+            self.build_lookups()
+        return changed
+
+    def build_lookups(self):
+        self.by_path, self.by_name, self.by_id = {}, {}, {}
+        self.resolved = {}
+        for relative_dir in sorted(self.dirs):
+            for file_name in self.dirs[relative_dir][1]:
+                path = posixpath.join(relative_dir, file_name)
+                self.by_path[path] = path
+                self.by_name.setdefault(file_name, path)
+                stem = file_name.split('.')[0]
+                if stem.isdigit():
+                    self.by_id.setdefault(stem, path)
+
+    def resolve(self, url):
+        if url in self.resolved:
+            return self.resolved[url]
+        local = self.resolved[url] = self.lookup(url)
+        return local
+
+    def lookup(self, url):
+        path = asset_path(url)
+        if path in self.by_path:
             return path
-        else:
-            for root, _, files in os.walk(source_folder):
-                for file_name in files:
-                    local_file = os.path.join(root, file_name)
-                    with open(local_file, 'r', encoding='utf-8') as file:
-                        if file:
-                            local_path = local_file
-            return local_path or path.replace('', 'https://confluence.com/')
-                
-                    
-
-
-def run_conversion():
-    if os.path.exists(destination_folder):
-        shutil.rmtree(destination_folder)
-    os.makedirs(destination_folder)
-    n = 0
-    n_errors = 0
-    table = build_url_table()
-    toc_structure = extract_toc_structure(index_file)
-    toc_tree = create_toc_tree(toc_structure)
-    filename_len = 20
+        name = posixpath.basename(path)
+        stem = name.split('.')[0]
+        if urllib.parse.urlsplit(url).scheme:
+            # Only Confluence attachment URLs are mapped back to local files
+            if '/attachments/' in path and stem.isdigit():
+                return self.by_id.get(stem)
+            return None
+        if stem.isdigit() and stem in self.by_id:
+            return self.by_id[stem]
+        return self.by_name.get(name)
+
+    @classmethod
+    def from_paths(cls, root, paths):
+        # Index of a listing that is not on disk, such as archive members;
+        # paths are relative to root, separated by '/'
+        index = cls(root)
+        for path in paths:
+            relative_dir, file_name = posixpath.split(path)
+            entry = index.dirs.setdefault(relative_dir, (None, [], []))
+            if is_asset(file_name):
+                entry[1].append(file_name)
+        for entry in index.dirs.values():
+            entry[1].sort()
+        index.build_lookups()
+        return index
+
+    def save(self, path):
+        save_pickle(self, path)
+
+    @classmethod
+    def load(cls, root, path=None):
+        index = load_pickle(path) if path else None
+        if not isinstance(index, cls) or index.root != root:
+            index = cls(root)
+        index.refresh()
+        return index
+
+
+def asset_index_path(root):
+    key = hashlib.sha256(os.path.abspath(root).encode('utf-8')).hexdigest()
+    return os.path.join(cache_folder, f"assets-{key}.pickle")
+
+
+def load_asset_index(root):
+    if not persist_asset_index:
+        return AssetIndex.load(root)
+    path = asset_index_path(root)
+    index = AssetIndex.load(root, path)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        index.save(path)
+    except OSError as e:
+        logging.warning(f"Could not write asset index {path}: {e}")
+    return index
+
+
+def check_local_asset(path, assets=None):
+    # Local path of the asset if it was exported, otherwise take the
+    # file/page from Confluence
+    if assets is None:
+        assets = load_asset_index(source_folder)
+    return assets.resolve(path) or 'https://confluence.com/' + path
+
+
+def convert_file(source_file_path, table, toc_index, parser='html.parser',
+                 assets=None, profiler=None, cache=None, source=None, destination=None,
+                 dependencies=None, noise=None):
+    # Returns the output path relative to the destination folder, or None
+    # when the file is neither a page nor an allowed asset. The folders
+    # default to source_folder and destination_folder. A dependencies dict
+    # receives what a page's Markdown depends on besides its HTML.
+    source = source or source_folder
+    destination = destination or destination_folder
+    file_name = os.path.basename(source_file_path)
+    relative_path = os.path.relpath(source_file_path, source)
+    destination_file_path = os.path.join(destination, relative_path)
+
+    os.makedirs(os.path.dirname(destination_file_path), exist_ok=True)
+
+    if file_name.endswith('.html'):
+        updated_filename = replace_filename(file_name, table)
+        destination_file = destination + '/' + updated_filename
+
+        start = time.perf_counter()
+        with open(source_file_path, 'r', encoding='utf-8') as page, \
+                open(destination_file, 'w', encoding='utf-8') as file:
+            if stream_pages_over is not None and \
+                    os.path.getsize(source_file_path) > stream_pages_over:
+                # Imported here, md_stream_converter builds on this module
+                from md_stream_converter import StreamingMarkdownConverter
+                converter = StreamingMarkdownConverter(table, file, assets, noise)
+                converter.convert(page)
+                parse_time, size = None, converter.output.size
+                links, images = converter.links, converter.images
+            elif cache:
+                markdown, parse_time, links, images = convert_html(
+                    page.read(), table, parser, assets, profiler, cache, noise)
+                file.write(markdown)
+                size = len(markdown)
+            else:
+                converter = HTMLToMarkdownConverter(table, parser, assets, profiler, noise)
+                converter.convert(page.read(), file)
+                parse_time, size = converter.parse_time, converter.output.size
+                links, images = converter.links, converter.images
+            fragment = toctree_fragment(toc_index, table[file_name]) \
+                if file_name in table else ''
+            file.write(fragment)
+
+        if dependencies is not None:
+            dependencies.update(page_dependencies(links, images, fragment))
+
+        if profiler:
+            profiler.add_page(file_name, time.perf_counter() - start, parse_time,
+                              os.path.getsize(source_file_path), size)
+        return updated_filename
+
+    elif is_asset(file_name):
+        shutil.copyfile(source_file_path, destination_file_path)
+        return relative_path
 
-    write_index_rst(toc_tree, index_rst, 'ARTPLATSWS')
+    return None
 
-    for root, _, files in os.walk(source_folder):
-        for file_name in files:
-            try:
-                print(f"[{n+1}/{len(files)}] Processing: {file_name}" +
-                      ' '*filename_len, end='\r')
-                filename_len = len(file_name)
 
-                source_file_path = os.path.join(root, file_name)
-                relative_path = os.path.relpath(
-                    source_file_path, source_folder)
-                destination_file_path = os.path.join(
-                    destination_folder, relative_path)
+def convert_html(html, table, parser='html.parser', assets=None, profiler=None,
+                 cache=None, noise=None):
+    # Returns (Markdown, parse time, rewritten links, rewritten images),
+    # taking them from the cache when it has the page; the parse time is
+    # None then
+    key = cache.key(html) if cache else None
+    entry = cache.get(key) if cache else None
+    if entry is not None:
+        return entry['markdown'], None, entry['links'], entry['images']
+    converter = HTMLToMarkdownConverter(table, parser, assets, profiler, noise)
+    markdown = converter.convert(html)
+    if cache:
+        cache.put(key, {'markdown': markdown, 'links': converter.links,
+                        'images': converter.images})
+    return markdown, converter.parse_time, converter.links, converter.images
+
+
+def page_dependencies(links, images, fragment):
+    return {'links': links, 'images': images,
+            'toc': hashlib.sha256(fragment.encode('utf-8')).hexdigest()}
+
+
+# ----------------- CACHE -------------------
+
+def cache_context(table, parser, assets, noise=None):
+    # Everything besides the page HTML that the converted Markdown depends on
+    data = json.dumps([converter_version, parser, list(table.items()),
+                       sorted(assets.by_path) if assets is not None else None,
+                       (noise or space_noise()).selectors])
+    return hashlib.sha256(data.encode('utf-8')).digest()
+
+
+class ConversionCache:
+    # Directory store of converted pages (the Markdown and the links and
+    # images rewritten in it), keyed by the hash of the page HTML
+    # and of its cache_context. Entries are written to a temporary file and
+    # renamed into place, so runs on several machines can share the folder
+    # without ever reading a partial entry. A hit touches the entry and
+    # evict() removes the least recently used ones beyond max_bytes.
+    def __init__(self, folder, max_bytes, context):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.context = context
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def key(self, html):
+        return hashlib.sha256(self.context + html.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key[2:] + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            # Missing, or evicted by another run in the meantime
+            self.stats['misses'] += 1
+            return None
+        if not isinstance(entry, dict) or 'markdown' not in entry:
+            # Written by a version that stored only the Markdown; put()
+            # replaces it
+            self.stats['misses'] += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # Another user's entry; it is still used, it just ages sooner
+            pass
+        self.stats['hits'] += 1
+        return entry
+
+    def put(self, key, entry):
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            descriptor, temporary = create_temporary(path)
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+                json.dump(entry, file)
+            os.replace(temporary, path)
+        except OSError as e:
+            logging.warning(f"Could not write conversion cache entry {path}: {e}")
+
+    def take_stats(self):
+        # Hits and misses since the last call, for worker processes to
+        # report back with their results
+        stats, self.stats = self.stats, {'hits': 0, 'misses': 0}
+        return stats
+
+    def merge_stats(self, stats):
+        self.stats['hits'] += stats['hits']
+        self.stats['misses'] += stats['misses']
+
+    def evict(self):
+        entries = []
+        total = 0
+        stale = time.time() - stale_cache_files
+        for root, _, files in os.walk(self.folder):
+            for file_name in files:
+                if not file_name.endswith(('.json', '.tmp')):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                    if file_name.endswith('.tmp'):
+                        if stat.st_mtime < stale:
+                            os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        return evicted
+
+    def summary(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        rate = 100 * self.stats['hits'] / lookups if lookups else 0
+        return f"{self.stats['hits']} hits, {self.stats['misses']} misses ({rate:.0f}% hit rate)"
+
+
+# ----------------- LIBRARY -------------------
+
+def configure(source, destination, space=None):
+    # Points the module-level paths at one space export; the space name
+    # defaults to the name of the source folder
+    global source_folder, destination_folder, index_file, toctree_rst_file, \
+        index_rst, space_name
+    source_folder = source
+    destination_folder = destination
+    index_file = os.path.join(source, 'index.html')
+    toctree_rst_file = index_rst = os.path.join(destination, 'index.rst')
+    # An archive export is named by convert_archive, after its top folder
+    space_name = space or (None if os.path.isfile(source)
+                           else os.path.basename(os.path.normpath(source)))
+
+
+def load_space(index_path, parser='html.parser'):
+    # Link table and toctree fragments of a space, for convert_many. The
+    # index model is parsed once per process and cached on disk.
+    table = dict(load_index(index_path, parser)['table'])
+    toc_index = build_toctree_index(
+        create_toc_tree(extract_toc_structure(index_path, parser)))
+    return table, toc_index
+
+
+def convert_many(pages, table, toc_index, parser='html.parser', assets=None, noise=None):
+    # Converts (file name, html) pairs and yields (Markdown file name,
+    # Markdown) with the content convert_file would write, reusing one
+    # converter for every page
+    converter = HTMLToMarkdownConverter(table, parser, assets, noise=noise)
+    for file_name, html in pages:
+        markdown = converter.convert(html)
+        if file_name in table:
+            markdown += toctree_fragment(toc_index, table[file_name])
+        yield replace_filename(file_name, table), markdown
+
+
+# ----------------- MANIFEST -------------------
+
+def hash_index(table, toc_tree, parser):
+    # Pages must be rebuilt whenever the link table, the TOC or the parser
+    # backend changes
+    data = json.dumps([list(table.items()), toc_tree, parser])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# In memory, pages list the hrefs and image srcs they use, and the manifest's
+# links and images map each of them to what it resolved to. On disk every
+# href and src is stored once, as an [href, target] pair, and pages list the
+# positions of their pairs.
+
+def load_manifest(destination=None):
+    manifest_path = os.path.join(destination or destination_folder, manifest_file)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {'files': {}, 'links': {}, 'images': {}}
+    for key in ('links', 'images'):
+        pairs = manifest.get(key)
+        manifest[key] = {}
+        for entry in manifest['files'].values():
+            if key not in entry:
+                continue
+            if pairs is None:
+                # Written when every page stored its own href -> target dict
+                manifest[key].update(entry[key])
+                entry[key] = list(entry[key])
+            else:
+                entry[key] = [pairs[number][0] for number in entry[key]]
+        if pairs is not None:
+            manifest[key] = dict(pairs)
+    return manifest
+
+
+def save_manifest(manifest, destination=None):
+    manifest_path = os.path.join(destination or destination_folder, manifest_file)
+    files = dict(manifest['files'])
+    saved = dict(manifest, files=files)
+    for key in ('links', 'images'):
+        numbers, pairs = {}, []
+        for relative_path, entry in files.items():
+            if key not in entry:
+                continue
+            references = []
+            for reference in entry[key]:
+                if reference not in numbers:
+                    numbers[reference] = len(pairs)
+                    pairs.append([reference, manifest[key][reference]])
+                references.append(numbers[reference])
+            files[relative_path] = dict(entry, **{key: references})
+        saved[key] = pairs
+    # json.dumps encodes in C; json.dump to a file uses the Python encoder
+    data = json.dumps(saved)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as file:
+        file.write(data)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def manifest_entry(source_file_path, output, index_hash, dependencies=None, context=None):
+    stat = os.stat(source_file_path)
+    entry = {
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'output': output,
+        'index': index_hash if source_file_path.endswith('.html') else None,
+    }
+    if dependencies:
+        entry.update(dependencies, links=list(dependencies['links']),
+                     images=list(dependencies['images']), context=context)
+    return entry
+
+
+def is_up_to_date(entry, source_file_path, index_hash, destination=None,
+                  dependencies_changed=None):
+    # Pages that recorded their dependencies are checked against them, so a
+    # new index.html only rebuilds the pages it affects; others are rebuilt
+    # whenever the index changes
+    if not entry:
+        return False
+    stat = os.stat(source_file_path)
+    if entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+        return False
+    if 'links' in entry and dependencies_changed:
+        if dependencies_changed(entry, source_file_path):
+            return False
+    elif entry['index'] is not None and entry['index'] != index_hash:
+        return False
+    return entry['output'] is None or \
+        os.path.exists(os.path.join(destination or destination_folder, entry['output']))
+
+
+def remove_stale_outputs(old_files, new_files, destination=None):
+    outputs = {entry['output'] for entry in new_files.values()}
+    for entry in old_files.values():
+        output = entry['output']
+        if output and output not in outputs:
+            output_path = os.path.join(destination or destination_folder, output)
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+
+# ----------------- ASSETS -------------------
+
+# ioctl that makes a copy-on-write clone of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+class AssetCopier:
+    # Copies assets into their destination folder from a thread pool. It prefers
+    # a reflink, then a hardlink to the source, and only then copies bytes,
+    # in-kernel with copy_file_range. Copied files are hashed, so later
+    # files with the same content become hardlinks to the first copy.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copies = {}
+        self.stats = {'copied': [0, 0], 'linked': [0, 0], 'deduplicated': [0, 0]}
+
+    def count(self, kind, size):
+        with self.lock:
+            self.stats[kind][0] += 1
+            self.stats[kind][1] += size
+
+    def copy(self, source_file_path, source=None, destination=None):
+        relative_path = os.path.relpath(source_file_path, source or source_folder)
+        destination_file_path = os.path.join(destination or destination_folder, relative_path)
+        os.makedirs(os.path.dirname(destination_file_path), exist_ok=True)
+        # Never write through an existing file, it may be a link to a source
+        if os.path.lexists(destination_file_path):
+            os.remove(destination_file_path)
+
+        size = os.path.getsize(source_file_path)
+        if reflink(source_file_path, destination_file_path) or \
+                (hardlink_assets and hardlink(source_file_path, destination_file_path)):
+            self.count('linked', size)
+            return relative_path
+
+        digest = file_hash(source_file_path)
+        with self.lock:
+            first_copy = self.copies.setdefault(digest, destination_file_path)
+        if first_copy != destination_file_path and \
+                hardlink(first_copy, destination_file_path):
+            self.count('deduplicated', size)
+        else:
+            copy_file(source_file_path, destination_file_path)
+            self.count('copied', size)
+        return relative_path
 
-                os.makedirs(os.path.dirname(
-                    destination_file_path), exist_ok=True)
+    def summary(self):
+        return ', '.join(f"{n} {kind} ({size / 1e6:.1f} MB)"
+                         for kind, (n, size) in self.stats.items())
 
-                if file_name.endswith('.html'):
-                    with open(source_file_path, 'r', encoding='utf-8') as file:
-                        html_content = file.read()
 
-                    converter = HTMLToMarkdownConverter(table)
-                    markdown_content = converter.convert(html_content)
+def reflink(source, destination):
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (OSError, NameError):
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
 
-                    updated_filename = replace_filename(file_name, table)
-                    destination_file = destination_folder + '/' + updated_filename
 
-                    with open(destination_file, 'w', encoding='utf-8') as file:
-                        file.write(markdown_content)
-                        if file_name in table:
-                            write_toctree(toc_tree, file, table[file_name])
+def hardlink(source, destination):
+    try:
+        os.link(source, destination)
+        return True
+    except OSError:
+        return False
+
+
+def copy_file(source, destination):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                pass
+        except (OSError, AttributeError):
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ----------------- PROGRESS -------------------
+
+# Metrics written to metrics_file, as (name, Prometheus type, help)
+progress_metrics = (
+    ('files', 'gauge', "Files to convert or copy in this run"),
+    ('files_done_total', 'counter', "Files converted, copied or failed"),
+    ('pages_done_total', 'counter', "HTML pages converted or failed"),
+    ('errors_total', 'counter', "Files that failed"),
+    ('bytes_in_total', 'counter', "Bytes of source files read"),
+    ('bytes_out_total', 'counter', "Bytes of Markdown and assets written"),
+    ('pages_per_second', 'gauge', "Pages done per second since the start of the run"),
+    ('queue_depth', 'gauge', "Files read or queued but not written yet"),
+    ('elapsed_seconds', 'gauge', "Seconds since the start of the run"),
+)
+
+
+class ProgressReporter:
+    # Counts finished files against the total, known before the run starts,
+    # and prints a progress line at most every progress_interval seconds on
+    # a terminal (log_progress_interval, one line each, when the output goes
+    # to a log). The same counters and a per-page latency histogram are
+    # written to metrics_path on every progress line.
+    def __init__(self, total, metrics_path=None):
+        self.total = total
+        self.metrics_path = metrics_path
+        self.tty = sys.stdout.isatty()
+        self.interval = progress_interval if self.tty else log_progress_interval
+        self.start = time.perf_counter()
+        self.last = None
+        # files_done_total at the last report
+        self.reported = None
+        self.width = 0
+        self.current = ''
+        # Set by the pipeline from the sizes of its queues; files not done
+        # yet otherwise
+        self.queue_depth = None
+        self.counts = dict.fromkeys(['files_done_total', 'pages_done_total', 'errors_total',
+                                     'bytes_in_total', 'bytes_out_total'], 0)
+        self.buckets = [0] * (len(latency_buckets) + 1)
+        self.latency_sum = 0.0
+
+    def update(self, file_name, error=None, seconds=None, bytes_in=0, bytes_out=0):
+        counts = self.counts
+        counts['files_done_total'] += 1
+        counts['pages_done_total'] += file_name.endswith('.html')
+        counts['errors_total'] += error is not None
+        counts['bytes_in_total'] += bytes_in
+        counts['bytes_out_total'] += bytes_out
+        if seconds is not None:
+            self.buckets[bisect.bisect_left(latency_buckets, seconds)] += 1
+            self.latency_sum += seconds
+        self.current = file_name
+        now = time.perf_counter()
+        if self.last is None or now - self.last >= self.interval:
+            self.report(now)
+
+    def values(self, now):
+        elapsed = now - self.start
+        queue_depth = self.queue_depth if self.queue_depth is not None else \
+            self.total - self.counts['files_done_total']
+        return dict(self.counts, files=self.total, queue_depth=queue_depth,
+                    pages_per_second=self.counts['pages_done_total'] / elapsed if elapsed else 0.0,
+                    elapsed_seconds=elapsed)
+
+    def report(self, now=None):
+        now = now or time.perf_counter()
+        self.last = now
+        self.reported = self.counts['files_done_total']
+        values = self.values(now)
+        if self.current:
+            line = f"[{values['files_done_total']}/{self.total}] " \
+                   f"{values['pages_per_second']:.1f} pages/s Processing: {self.current}"
+            if self.tty:
+                print(line.ljust(self.width), end='\r')
+                self.width = len(line)
+            else:
+                print(line)
+        if self.metrics_path:
+            self.write_metrics(values)
+
+    def close(self):
+        if self.reported != self.counts['files_done_total']:
+            self.report()
+
+    def write_metrics(self, values):
+        if self.metrics_path.endswith('.prom'):
+            # Replaced atomically, for a node_exporter textfile collector; the
+            # file gets the same mode under the umask as the cache files
+            descriptor, temporary = create_temporary(self.metrics_path)
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+                file.write(self.prometheus_text(values))
+            os.replace(temporary, self.metrics_path)
+        else:
+            histogram = {'buckets': dict(zip([str(le) for le in latency_buckets] + ['+Inf'],
+                                             self.cumulative_buckets())),
+                         'sum': self.latency_sum, 'count': sum(self.buckets)}
+            with open(self.metrics_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(dict(values, time=time.time(),
+                                           page_seconds=histogram)) + '\n')
+
+    def cumulative_buckets(self):
+        total = 0
+        counts = []
+        for count in self.buckets:
+            total += count
+            counts.append(total)
+        return counts
+
+    def prometheus_text(self, values):
+        lines = []
+        for name, kind, description in progress_metrics:
+            lines += [f"# HELP md_converter_{name} {description}.",
+                      f"# TYPE md_converter_{name} {kind}",
+                      f"md_converter_{name} {values[name]}"]
+        lines += ["# HELP md_converter_page_seconds Seconds taken to convert a page.",
+                  "# TYPE md_converter_page_seconds histogram"]
+        for le, count in zip([str(le) for le in latency_buckets] + ['+Inf'],
+                             self.cumulative_buckets()):
+            lines.append(f'md_converter_page_seconds_bucket{{le="{le}"}} {count}')
+        lines += [f"md_converter_page_seconds_sum {self.latency_sum}",
+                  f"md_converter_page_seconds_count {sum(self.buckets)}"]
+        return '\n'.join(lines) + '\n'
+
+
+# ----------------- CONVERSION -------------------
+
+class Space:
+    # One space export being converted: its folders, the link table and TOC
+    # built from its index.html, and the manifest entries of this run
+    def __init__(self, source, destination, title=None, index=None, index_rst=None):
+        self.source = source
+        self.destination = destination
+        self.title = title or os.path.basename(os.path.normpath(source))
+        self.index = index or os.path.join(source, 'index.html')
+        self.index_rst = index_rst or os.path.join(destination, 'index.rst')
+        # Whether the last run got to finish(), so update() can start from it
+        self.finished = False
+
+    def prepare(self, parser, incremental, changed=None):
+        # changed is the set of source files a watch run saw change since
+        # the last run; update() then checks only those
+        if changed is not None and incremental and self.update(changed, parser):
+            return
+        self.finished = False
+        self.parser = parser
+        if not incremental and os.path.exists(self.destination):
+            shutil.rmtree(self.destination)
+        os.makedirs(self.destination, exist_ok=True)
+        self.table = dict(load_index(self.index, parser)['table'])
+        toc_tree = create_toc_tree(extract_toc_structure(self.index, parser))
+        self.toc_index = build_toctree_index(toc_tree)
+        self.assets = load_asset_index(self.source)
+        self.index_hash = hash_index(self.table, toc_tree, parser)
+        self.noise = space_noise(self.title)
+        self.context = f"{converter_version}-{parser}-{','.join(self.noise.selectors)}"
+        self.cache = ConversionCache(conversion_cache, conversion_cache_size,
+                                     cache_context(self.table, parser, self.assets,
+                                                   self.noise)) \
+            if conversion_cache else None
+
+        write_index_rst(toc_tree, self.index_rst, self.title)
+
+        self.source_files = [os.path.join(root, file_name)
+                             for root, _, files in os.walk(self.source)
+                             for file_name in files]
+        manifest = load_manifest(self.destination) if incremental else \
+            {'files': {}, 'links': {}, 'images': {}}
+        self.old_files = manifest['files']
+        # What the hrefs and image srcs of recorded pages resolved to
+        self.link_targets = manifest['links']
+        self.image_urls = manifest['images']
+        self.new_files = {}
+        self.pending = []
+        self.resolved_links = {}
+        self.resolved_images = {}
+        for source_file_path in self.source_files:
+            relative_path = os.path.relpath(source_file_path, self.source)
+            entry = self.old_files.get(relative_path)
+            try:
+                up_to_date = is_up_to_date(entry, source_file_path, self.index_hash,
+                                           self.destination, self.dependencies_changed)
+            except FileNotFoundError:
+                # Deleted since the folder was listed; its output is
+                # removed as stale
+                continue
+            if up_to_date:
+                if entry['index'] is not None:
+                    entry = dict(entry, index=self.index_hash)
+                self.new_files[relative_path] = entry
+            elif os.path.exists(source_file_path):
+                self.pending.append(source_file_path)
+
+    def update(self, changed, parser):
+        # Prepares a watch run from the state the last run left in memory,
+        # without listing the source folder or loading the manifest. Returns
+        # False when that state cannot be used: the last run failed or used
+        # another parser, or index.html changed and every page may need
+        # converting again.
+        if not self.finished or parser != self.parser or self.index in changed:
+            return False
+        self.finished = False
+        prefix = os.path.join(self.source, '')
+        changed = {path for path in changed if path.startswith(prefix)}
+        self.old_files = self.new_files
+        self.new_files = dict(self.old_files)
+        self.pending = []
+        self.resolved_links = {}
+        self.resolved_images = {}
+        if self.assets.refresh():
+            # Assets were added or removed: pages linking to them resolve
+            # differently, and cached pages were converted without them
+            self.cache = ConversionCache(conversion_cache, conversion_cache_size,
+                                         cache_context(self.table, self.parser, self.assets,
+                                                       self.noise)) \
+                if conversion_cache else None
+            for relative_path, entry in self.old_files.items():
+                source_file_path = os.path.join(self.source, relative_path)
+                if 'links' in entry and source_file_path not in changed and \
+                        self.dependencies_changed(entry, source_file_path):
+                    del self.new_files[relative_path]
+                    self.pending.append(source_file_path)
+
+        source_files = set(self.source_files)
+        for source_file_path in changed:
+            relative_path = os.path.relpath(source_file_path, self.source)
+            entry = self.new_files.pop(relative_path, None)
+            try:
+                up_to_date = is_up_to_date(entry, source_file_path, self.index_hash,
+                                           self.destination, self.dependencies_changed)
+            except FileNotFoundError:
+                # Removed; its output is removed as stale
+                source_files.discard(source_file_path)
+                continue
+            source_files.add(source_file_path)
+            if up_to_date:
+                self.new_files[relative_path] = entry
+            else:
+                self.pending.append(source_file_path)
+        self.source_files = sorted(source_files)
+        return True
 
-                else:
-                    for format in allowed_formats:
-                        if file_name.endswith(format) or (file_name.isdigit() and not '.' in file_name):
-                            shutil.copyfile(source_file_path,
-                                            destination_file_path)
-                            
-                n += 1
+    def dependencies_changed(self, entry, source_file_path):
+        # Whether a page would convert differently with the current link
+        # table, toctree and assets. Each recorded href is resolved once per
+        # run however many pages link to it.
+        if entry.get('context') != self.context:
+            return True
+        file_name = os.path.basename(source_file_path)
+        if entry['output'] != replace_filename(file_name, self.table):
+            return True
+        fragment = toctree_fragment(self.toc_index, self.table[file_name]) \
+            if file_name in self.table else ''
+        if entry['toc'] != page_dependencies({}, {}, fragment)['toc']:
+            return True
+        links, images = self.resolved_links, self.resolved_images
+        for href in entry['links']:
+            if href not in links:
+                links[href] = resolve_link(href, self.table, self.assets)
+            if href not in self.link_targets or links[href] != self.link_targets[href]:
+                return True
+        for src in entry['images']:
+            if src not in images:
+                images[src] = resolve_image(src, self.assets)
+            if src not in self.image_urls or images[src] != self.image_urls[src]:
+                return True
+        return False
+
+    def worker_state(self):
+        return (self.table, self.toc_index, self.assets, self.cache,
+                self.source, self.destination, self.noise)
+
+    def record(self, source_file_path, output, dependencies=None):
+        relative_path = os.path.relpath(source_file_path, self.source)
+        try:
+            self.new_files[relative_path] = manifest_entry(
+                source_file_path, output, self.index_hash, dependencies, self.context)
+        except FileNotFoundError:
+            return
+        if dependencies:
+            self.link_targets.update(dependencies['links'])
+            self.image_urls.update(dependencies['images'])
+
+    def finish(self):
+        remove_stale_outputs(self.old_files, self.new_files, self.destination)
+        save_manifest({'index': self.index_hash, 'files': self.new_files,
+                       'links': self.link_targets, 'images': self.image_urls},
+                      self.destination)
+        self.finished = True
+
+
+# Worker processes receive the URL table and toctree index of every space
+# once, at start-up, instead of with every task. Tasks are (space number,
+# page path) pairs.
+_worker_state = {}
+
+
+def _init_worker(spaces, parser, profile):
+    _worker_state['spaces'] = spaces
+    _worker_state['parser'] = parser
+    _worker_state['profile'] = profile
+
+
+def start_worker_pool(n_workers, worker_args):
+    # Call before starting any thread: forking a process that runs threads
+    # can deadlock the child. With fork, the pool forks all of its workers
+    # on the first submit, which is done here.
+    executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                   initargs=worker_args)
+    executor.submit(int)
+    return executor
+
+
+def _task_report(profiler, cache, start):
+    # Time taken, profile and cache statistics of a task, for the parent
+    return {'seconds': time.perf_counter() - start,
+            'profile': profiler and profiler.snapshot(),
+            'cache': cache and cache.take_stats()}
+
+
+def merge_report(report, profiler, cache):
+    if report and report['profile']:
+        profiler.merge(report['profile'])
+    if report and report['cache']:
+        cache.merge_stats(report['cache'])
+
+
+def _convert_file_task(task):
+    space, source_file_path = task
+    table, toc_index, assets, cache, source, destination, noise = \
+        _worker_state['spaces'][space]
+    profiler = ConversionProfiler() if _worker_state['profile'] else None
+    dependencies = {}
+    start = time.perf_counter()
+    try:
+        output = convert_file(source_file_path, table, toc_index, _worker_state['parser'],
+                              assets, profiler, cache, source, destination, dependencies,
+                              noise)
+        return output, dependencies, None, _task_report(profiler, cache, start)
+    except Exception as e:
+        return None, None, str(e), _task_report(profiler, cache, start)
+
+
+def _convert_page_task(task, html):
+    # Pipeline stage: converts a page already read into memory and returns
+    # (file name, Markdown, dependencies, error, report). Pages over
+    # stream_pages_over arrive without html and are converted by
+    # convert_file, which streams.
+    if html is None:
+        output, dependencies, error, report = _convert_file_task(task)
+        return output, None, dependencies, error, report
+    space, source_file_path = task
+    table, toc_index, assets, cache, _, _, noise = _worker_state['spaces'][space]
+    profiler = ConversionProfiler() if _worker_state['profile'] else None
+    start = time.perf_counter()
+    try:
+        file_name = os.path.basename(source_file_path)
+        markdown, parse_time, links, images = convert_html(
+            html, table, _worker_state['parser'], assets, profiler, cache, noise)
+        if profiler:
+            profiler.add_page(file_name, time.perf_counter() - start, parse_time,
+                              len(html), len(markdown))
+        fragment = toctree_fragment(toc_index, table[file_name]) \
+            if file_name in table else ''
+        return replace_filename(file_name, table), markdown + fragment, \
+            page_dependencies(links, images, fragment), None, \
+            _task_report(profiler, cache, start)
+    except Exception as e:
+        return None, None, None, str(e), _task_report(profiler, cache, start)
+
+
+def read_page(source_file_path):
+    if stream_pages_over is not None and \
+            os.path.getsize(source_file_path) > stream_pages_over:
+        return None
+    with open(source_file_path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+
+def write_page(source_file_path, output, markdown, source=None, destination=None):
+    # Creates the same folders convert_file does
+    source = source or source_folder
+    destination = destination or destination_folder
+    relative_path = os.path.relpath(source_file_path, source)
+    os.makedirs(os.path.dirname(os.path.join(destination, relative_path)),
+                exist_ok=True)
+    with open(os.path.join(destination, output), 'w', encoding='utf-8') as file:
+        file.write(markdown)
+
+
+async def convert_pipelined(tasks, spaces, record, n_workers, worker_args, merge=None,
+                            progress=None, cpu_pool=None):
+    # Readers prefetch pages on threads, n_workers converters run in worker
+    # processes (a thread when n_workers is 1) and writers flush results on
+    # threads. The bounded queues hold back the readers when conversion
+    # falls behind, so at most about 2 * pipeline_queue_size pages are in
+    # memory at once. cpu_pool is a start_worker_pool() pool of the caller,
+    # who started it before any thread; otherwise one is started here.
+    loop = asyncio.get_running_loop()
+    read_queue = asyncio.Queue(pipeline_queue_size)
+    write_queue = asyncio.Queue(pipeline_queue_size)
+    own_pool = None
+    if cpu_pool is None:
+        if n_workers > 1:
+            cpu_pool = own_pool = start_worker_pool(n_workers, worker_args)
+        else:
+            _init_worker(*worker_args)
+            cpu_pool = own_pool = ThreadPoolExecutor(max_workers=1)
+    io_pool = ThreadPoolExecutor(max_workers=pipeline_io_threads)
+
+    async def read_ahead():
+        # A few reads are kept in flight, in task order
+        reads = asyncio.Queue(pipeline_io_threads)
+
+        async def submit():
+            for task in tasks:
+                await reads.put((task, loop.run_in_executor(io_pool, read_page, task[1])))
+            await reads.put(None)
+
+        submitter = asyncio.create_task(submit())
+        while (item := await reads.get()) is not None:
+            task, read = item
+            try:
+                await read_queue.put((task, await read, None))
+            except Exception as e:
+                await read_queue.put((task, None, str(e)))
+        await submitter
+        for _ in range(n_workers):
+            await read_queue.put(None)
+
+    async def convert():
+        while (item := await read_queue.get()) is not None:
+            task, html, error = item
+            if error is None:
+                result = await loop.run_in_executor(cpu_pool, _convert_page_task, task, html)
+            else:
+                result = None, None, None, error, None
+            await write_queue.put((task, result))
+
+    async def write(task, output, markdown, dependencies, seconds):
+        space = spaces[task[0]]
+        try:
+            if markdown is not None:
+                await loop.run_in_executor(io_pool, write_page, task[1], output, markdown,
+                                           space.source, space.destination)
+            record(task, output, None, dependencies, seconds)
+        except Exception as e:
+            record(task, None, str(e))
+
+    async def flush():
+        writes = set()
+        while (item := await write_queue.get()) is not None:
+            task, (output, markdown, dependencies, error, report) = item
+            if progress:
+                progress.queue_depth = read_queue.qsize() + write_queue.qsize() + len(writes)
+            if merge:
+                merge(task, report)
+            if error is not None:
+                record(task, None, error, None, report and report['seconds'])
+                continue
+            writes.add(asyncio.create_task(write(task, output, markdown, dependencies,
+                                                 report['seconds'])))
+            if len(writes) >= pipeline_io_threads:
+                _, writes = await asyncio.wait(writes, return_when=asyncio.FIRST_COMPLETED)
+        if writes:
+            await asyncio.wait(writes)
+
+    try:
+        writer = asyncio.create_task(flush())
+        await asyncio.gather(read_ahead(), *(convert() for _ in range(n_workers)))
+        await write_queue.put(None)
+        await writer
+    finally:
+        io_pool.shutdown()
+        if own_pool:
+            own_pool.shutdown()
+
+
+def convert_spaces(spaces, n_workers=None, incremental=False, parser=None, profile=None,
+                   changed=None):
+    # Converts any number of spaces with one worker pool. Pages of all spaces
+    # are scheduled together, largest first, so a few big pages do not hold
+    # up the end of the run. profile is the path of a JSON report on the
+    # slowest pages and the hottest converter handlers; None leaves the
+    # converter uninstrumented. changed is the set of source files a watch
+    # run saw change; only those are checked, and the cache is not evicted.
+    n_workers = n_workers or workers
+    parser = resolve_parser(parser or html_parser)
+    n_errors = 0
 
+    for space in spaces:
+        space.prepare(parser, incremental, changed)
+    n_pending = sum(len(space.pending) for space in spaces)
+    progress = ProgressReporter(n_pending, metrics_file)
+
+    def record(task, output, error, dependencies=None, seconds=None):
+        nonlocal n_errors
+        space_number, source_file_path = task
+        file_name = os.path.basename(source_file_path)
+        bytes_in = bytes_out = 0
+        if error is not None:
+            logging.error(
+                f"\033[91m An error occurred in {file_name}: {error} \033[0m")
+            n_errors += 1
+        else:
+            spaces[space_number].record(source_file_path, output, dependencies)
+            if output is not None:
+                bytes_in = source_size(source_file_path)
+                bytes_out = os.path.getsize(
+                    os.path.join(spaces[space_number].destination, output))
+        progress.update(file_name, error, seconds, bytes_in, bytes_out)
+
+    def merge(task, report):
+        merge_report(report, profiler, spaces[task[0]].cache)
+
+    profiler = ConversionProfiler() if profile else None
+    worker_args = ([space.worker_state() for space in spaces], parser, bool(profile))
+
+    tasks = [(i, path) for i, space in enumerate(spaces) for path in space.pending]
+    pages = sorted((task for task in tasks if task[1].endswith('.html')),
+                   key=lambda task: source_size(task[1]), reverse=True)
+    others = [task for task in tasks if not task[1].endswith('.html')]
+
+    # Worker processes are started before the threads below
+    executor = start_worker_pool(n_workers, worker_args) \
+        if n_workers > 1 and (len(pages) > 1 or async_pipeline and pages) else None
+
+    # Assets are copied on threads while the pages are being converted
+    copier = AssetCopier()
+    copy_pool = ThreadPoolExecutor(max_workers=asset_threads)
+    copies = [(task, copy_pool.submit(copier.copy, task[1], spaces[task[0]].source,
+                                      spaces[task[0]].destination))
+              for task in others if is_asset(os.path.basename(task[1]))]
+
+    if async_pipeline and pages:
+        try:
+            asyncio.run(convert_pipelined(pages, spaces, record, n_workers, worker_args, merge,
+                                          progress, executor))
+        finally:
+            if executor:
+                executor.shutdown()
+    elif executor:
+        chunksize = max(1, len(pages) // (n_workers * 16))
+        with executor:
+            results = executor.map(_convert_file_task, pages,
+                                   chunksize=chunksize)
+            for task, (output, dependencies, error, report) in zip(pages, results):
+                merge(task, report)
+                record(task, output, error, dependencies, report['seconds'])
+    else:
+        for task in pages:
+            space = spaces[task[0]]
+            dependencies = {}
+            start = time.perf_counter()
+            try:
+                output = convert_file(task[1], space.table, space.toc_index, parser,
+                                      space.assets, profiler, space.cache,
+                                      space.source, space.destination, dependencies,
+                                      space.noise)
+                record(task, output, None, dependencies, time.perf_counter() - start)
             except Exception as e:
-                logging.error(
-                    f"\033[91m An error occurred in {file_name}: {str(e)} \033[0m")
-                n += 1
-                n_errors += 1
+                record(task, None, str(e), None, time.perf_counter() - start)
+
+    for task in others:
+        if not is_asset(os.path.basename(task[1])):
+            record(task, None, None)
+    for task, future in copies:
+        try:
+            record(task, future.result(), None)
+        except Exception as e:
+            record(task, None, str(e))
+    copy_pool.shutdown()
+    progress.queue_depth = None
+    progress.close()
+
+    for space in spaces:
+        space.finish()
+
+    skipped = sum(len(space.source_files) for space in spaces) - n_pending
+    if incremental:
+        print(f"\n{n_pending} files converted, {skipped} unchanged.")
+    print(f"\nAssets: {copier.summary()}")
+    if conversion_cache:
+        cache = ConversionCache(conversion_cache, conversion_cache_size, b'')
+        for space in spaces:
+            cache.merge_stats(space.cache.stats)
+        if changed is None:
+            cache.evict()
+        print(f"Conversion cache: {cache.summary()}")
+    if profiler:
+        profiler.save(profile)
+        print(f"Profile written to {profile}")
 
     if n_errors == 0:
         print(
@@ -498,4 +2177,124 @@ def run_conversion():
             f"HTML to Markdown conversion completed.\n\033[91m{n_errors} Errors.")
 
 
-run_conversion()
+def source_size(source_file_path):
+    # 0 for a file deleted since the source folder was listed
+    try:
+        return os.path.getsize(source_file_path)
+    except FileNotFoundError:
+        return 0
+
+
+def configured_space():
+    return Space(source_folder, destination_folder, space_name, index_file, index_rst)
+
+
+def run_conversion(n_workers=None, incremental=False, parser=None, profile=None):
+    # source_folder may also be a zip or tar export, and destination_folder
+    # an archive to write (see md_archive)
+    if os.path.isfile(source_folder):
+        # Imported here, md_archive builds on this module
+        from md_archive import convert_archive
+        convert_archive(source_folder, destination_folder, space_name, n_workers,
+                        parser, profile)
+        return
+    convert_spaces([configured_space()], n_workers, incremental, parser, profile)
+
+
+def batch_spaces(space_roots, destination):
+    # Each space is written to destination/<space folder name> with its own
+    # index.rst
+    names = [os.path.basename(os.path.normpath(root)) for root in space_roots]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Space folders must have distinct names: {names}")
+    return [Space(root, os.path.join(destination, name))
+            for root, name in zip(space_roots, names)]
+
+
+def run_batch(space_roots, destination, n_workers=None, incremental=False,
+              parser=None, profile=None):
+    # Converts several space exports in one run
+    convert_spaces(batch_spaces(space_roots, destination), n_workers, incremental,
+                   parser, profile)
+
+
+
+# ----------------- WATCH -------------------
+
+class SourceWatcher:
+    # Polls folders for added, removed and modified files. Directory
+    # listings are cached and read again only when a directory's mtime
+    # changes; files are compared with a cache of their mtime and size.
+    def __init__(self, roots):
+        self.roots = roots
+        self.dirs = {}
+        self.stats = {}
+        self.poll()
+
+    def poll(self):
+        # Returns the set of files added, removed or modified since the last
+        # poll
+        stats = {}
+        seen = set()
+        pending = list(self.roots)
+        while pending:
+            folder = pending.pop()
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen.add(folder)
+            entry = self.dirs.get(folder)
+            if not entry or entry[0] != mtime:
+                files, subdirs = [], []
+                with os.scandir(folder) as entries:
+                    for dir_entry in entries:
+                        (subdirs if dir_entry.is_dir() else files).append(dir_entry.path)
+                entry = self.dirs[folder] = (mtime, files, subdirs)
+            pending.extend(entry[2])
+            for file_path in entry[1]:
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                stats[file_path] = (stat.st_mtime_ns, stat.st_size)
+
+        for folder in set(self.dirs) - seen:
+            del self.dirs[folder]
+        changed = {path for path in stats.keys() | self.stats.keys()
+                   if stats.get(path) != self.stats.get(path)}
+        self.stats = stats
+        return changed
+
+
+def watch(spaces, n_workers=None, parser=None, interval=None):
+    # Converts the spaces, then keeps polling their sources and runs an
+    # incremental conversion whenever something changed, until interrupted.
+    # Only the files the watcher saw change are checked, against the state
+    # the last run left in memory; index.rst and the toctree sections of
+    # every page are rebuilt only when index.html changed.
+    # A run that fails, typically because the export is being replaced
+    # while it is read, is logged and tried again on the next change.
+    watcher = SourceWatcher([space.source for space in spaces])
+
+    def convert(changed=None):
+        try:
+            convert_spaces(spaces, n_workers, True, parser, changed=changed)
+        except Exception as e:
+            logging.error(f"\033[91m Conversion failed, retrying on the next change: "
+                          f"{e} \033[0m")
+
+    convert()
+    print(f"Watching {', '.join(space.source for space in spaces)} for changes...")
+    try:
+        while True:
+            time.sleep(interval or watch_interval)
+            changed = watcher.poll()
+            if changed:
+                convert(changed)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run_conversion()
@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+
+
+# md_converter (and with it bs4) is imported only once the arguments are
+# valid, so --help and usage errors return immediately
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert Confluence HTML space exports to Markdown")
+    parser.add_argument('sources', nargs='+', metavar='source',
+                        help="folder of a space export, containing index.html, "
+                             "or a zip or tar of one")
+    parser.add_argument('destination',
+                        help="folder the Markdown is written to, or a .zip or .tar[.gz] "
+                             "for an archive source; with several sources, each space "
+                             "goes to a subfolder named after its source folder")
+    parser.add_argument('--space', help="title of index.rst (default: name of the source folder)")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only convert files changed since the last run")
+    parser.add_argument('--parser', help="'html.parser', 'lxml', 'html5lib' or 'auto'")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and convert again whatever changes in the sources")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="overlap reading, converting and writing pages (for slow storage)")
+    parser.add_argument('--cache', help="folder of a conversion cache to reuse and update")
+    parser.add_argument('--profile', help="write a JSON profile of the run to this file")
+    parser.add_argument('--strip', action='append', default=[], metavar='SELECTOR',
+                        help="also leave out elements matching this selector (tag, #id, "
+                             ".class, tag#id or tag.class); may be repeated")
+    parser.add_argument('--metrics', help="keep run metrics in this file: Prometheus text "
+                                          "format for a .prom file, JSON lines otherwise")
+    args = parser.parse_args(argv)
+    for source in args.sources:
+        if os.path.isfile(source):
+            if len(args.sources) > 1 or args.incremental or args.watch:
+                parser.error("an archive source is converted on its own, in full")
+        elif not os.path.isfile(os.path.join(source, 'index.html')):
+            parser.error(f"no index.html in {source}")
+    if args.space and len(args.sources) > 1:
+        parser.error("--space only applies to a single source")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    import md_converter
+    md_converter.async_pipeline = args.pipeline
+    md_converter.conversion_cache = args.cache
+    md_converter.metrics_file = args.metrics and os.path.abspath(args.metrics)
+    md_converter.noise_selectors = md_converter.noise_selectors + args.strip
+    try:
+        md_converter.space_noise()
+    except ValueError as e:
+        sys.exit(f"error: {e}")
+    sources = [os.path.abspath(source) for source in args.sources]
+    destination = os.path.abspath(args.destination)
+    if args.watch:
+        if len(sources) > 1:
+            spaces = md_converter.batch_spaces(sources, destination)
+        else:
+            md_converter.configure(sources[0], destination, args.space)
+            spaces = [md_converter.configured_space()]
+        md_converter.watch(spaces, args.workers, args.parser)
+    elif len(sources) > 1:
+        md_converter.run_batch(sources, destination, args.workers,
+                               args.incremental, args.parser, args.profile)
+    else:
+        md_converter.configure(sources[0], destination, args.space)
+        md_converter.run_conversion(args.workers, args.incremental, args.parser, args.profile)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,502 @@
+from html.parser import HTMLParser
+import re
+
+from md_converter import HTMLToMarkdownConverter, MarkdownWriter, blank_lines, clean_text, \
+    end_row, header_text, indent_lines, item_text, place_cell, space_noise, span_value, spaces
+from md_converter import block_tags as cell_block_tags
+
+# Bytes read from the source page per feed() call
+chunk_size = 64 * 1024
+
+heading_tags = ('h1', 'h2', 'h3')
+inline_tags = ('a', 'em', 'strong', 'code', 's')
+list_tags = ('ul', 'ol')
+# Whitespace BeautifulSoup collapses between tags, and the tags it keeps it in
+ascii_spaces = ' \n\t\f\r'
+preserve_whitespace_tags = ('pre', 'textarea')
+# Tags that end an open paragraph, as in a browser's tree builder
+block_tags = ('p', 'div', 'table', 'ul', 'ol', 'pre', 'blockquote') + heading_tags
+# Blocks in a list item that end with a line break, as in render_inline
+item_block_tags = ('p', 'div', 'h4', 'h5', 'h6')
+
+
+class StreamingMarkdownConverter(HTMLParser):
+    # Converts a page from start/end/data events without building a tree.
+    # Markdown is written to the writer as soon as each paragraph, heading,
+    # list item or table row is complete, so memory is bounded by the largest
+    # of those rather than by the page. It renders the same constructs as
+    # HTMLToMarkdownConverter, except that short table rows are padded to the
+    # width of the first row because later rows are not known yet, and that
+    # a table in a cell is rendered into the cell rather than as rows of the
+    # outer table.
+    check_url = HTMLToMarkdownConverter.check_url
+    link_target = HTMLToMarkdownConverter.link_target
+    image_url = HTMLToMarkdownConverter.image_url
+
+    def __init__(self, table, file=None, assets=None, noise=None):
+        super().__init__(convert_charrefs=True)
+        self.table = table
+        self.assets = assets
+        self.noise = noise or space_noise()
+        self.output = MarkdownWriter(file)
+        self.has_title = False
+        self.links = {}
+        self.images = {}
+        self.skip_tag = None
+        self.skip_depth = 0
+        self.preserve_depth = 0
+        self.block = None
+        self.inline = []
+        # Open lists, innermost last, and the item whose text is collected
+        self.lists = []
+        self.item = None
+        # Whether the last line written is a list marker without text, as in
+        # HTMLToMarkdownConverter
+        self.empty_marker = False
+        self.table_depth = 0
+        self.list_table = None
+        self.cell = None
+        # Text of the open cell without markup, for header rows
+        self.cell_text = []
+        self.cell_span = (1, 1)
+
+    # ----- helpers -----
+
+    def target(self):
+        # Where text currently goes; None means it is dropped, like text the
+        # tree converter never visits
+        if self.inline:
+            return self.inline[-1]['parts']
+        if self.block is not None:
+            return self.block['parts']
+        if self.cell is not None:
+            return self.cell
+        return self.item
+
+    def emit(self, text):
+        # Rendered links, images and emphasis outside of any block are
+        # written directly, as the tree converter's handle_link and friends do
+        parts = self.target()
+        if parts is not None:
+            parts.append(text)
+        elif text.strip():
+            self.output.write(text.strip() + ' ')
+
+    def render_inline(self, frame):
+        text = ''.join(frame['parts'])
+        tag = frame['tag']
+        if tag == 'a':
+            href = frame['attrs'].get('href')
+            # A link around an image or another link is left out and its
+            # contents rendered, as the tree converter does
+            if not self.check_url(href) or frame['nested']:
+                return text
+            # Link and code text is plain, as get_text() in the tree converter
+            link_text = ''.join(frame['text']).strip() or 'link'
+            return f"[{link_text}]({self.link_target(href.strip())}) "
+        if tag == 'code':
+            text = ''.join(frame['text'])
+        stripped = text.strip()
+        if not stripped:
+            return text
+        marker = {'em': '*', 'strong': '**', 'code': '`', 's': '~~'}[tag]
+        leading = text[:len(text) - len(text.lstrip())]
+        trailing = text[len(text.rstrip()):]
+        return f"{leading}{marker}{stripped}{marker}{trailing}"
+
+    def write_block(self, text):
+        # Tables and headings in a list are indented to the item text, as
+        # HTMLToMarkdownConverter.render_nested does
+        if not self.lists:
+            self.output.write(text)
+            return
+        if self.empty_marker:
+            text = text.lstrip('\n')
+        self.empty_marker = False
+        self.output.write(indent_lines(text, self.lists[-1]['content']))
+
+    def image(self, attrs):
+        if self.block and self.block['tag'] in heading_tags:
+            self.heading_image(attrs)
+            return
+        src = attrs.get('src') or ''
+        if self.check_url(src) and not '/thumbnail/' in src:
+            alt_text = (attrs.get('alt') or 'Image').strip() or src
+            self.emit(f" ![{alt_text}]({self.image_url(src)}) ")
+
+    # ----- headings -----
+
+    # The tree converter writes a heading as plain text and then, after it,
+    # the links, images and emphasis in it, each rendered on its own. Outside
+    # of lists a heading block keeps those in 'after', in document order.
+
+    def heading_inline(self, tag, attrs):
+        after = self.block.get('after')
+        if after is not None:
+            self.block['open'].append((tag, attrs, len(self.block['parts']), len(after)))
+            after.append('')
+
+    def heading_inline_end(self, tag):
+        block = self.block
+        for i in range(len(block['open']) - 1, -1, -1):
+            if block['open'][i][0] == tag:
+                _, attrs, start, slot = block['open'].pop(i)
+                text = ''.join(block['parts'][start:])
+                if tag == 'em':
+                    block['after'][slot] = f"*{text.strip()}* "
+                elif tag == 'strong':
+                    block['after'][slot] = f"**{text.strip()}** " if text.strip() else ''
+                elif self.check_url(attrs.get('href')):
+                    block['after'][slot] = \
+                        f"[{(text or 'link').strip()}]({self.link_target(attrs['href'].strip())}) "
+                return
+
+    def heading_image(self, attrs):
+        after = self.block.get('after')
+        src = attrs.get('src') or ''
+        if after is not None and self.check_url(src) and not '/thumbnail/' in src:
+            alt_text = attrs.get('alt', 'Image') or ''
+            after.append(f"![{alt_text.strip()}]({self.image_url(src)}) ")
+
+    # ----- blocks -----
+
+    def close_block(self):
+        block, self.block = self.block, None
+        if block is None:
+            return
+        text = ''.join(block['parts']).strip()
+        if block['tag'] in heading_tags:
+            level = int(block['tag'][1])
+            if block['attrs'].get('id') == 'title-heading':
+                self.has_title = True
+                # Parse title removing unwanted part
+                match = re.search(r'[^:]+:\s(.*?)$', text)
+                if match:
+                    text = match.group(1)
+            elif self.has_title:
+                level += 1
+            self.write_block(f"\n\n{'#' * level} {text}\n\n")
+            for rendered in block.get('after') or ():
+                if rendered.strip():
+                    self.output.write(rendered)
+        elif text != 'TOC' and 'style' not in block['attrs']:
+            text = blank_lines.sub('\n\n', spaces.sub(' ', text))
+            self.output.write(f"\n{text}\n\n")
+
+    def close_inline(self):
+        while self.inline:
+            self.handle_endtag(self.inline[-1]['tag'])
+
+    def flush_item(self, nested=False):
+        # Writes the item before a nested list, table or heading starts
+        # (nested) or when it ends; text after one of those continues the
+        # item, without a marker, as a paragraph of its own
+        item, self.item = self.item, None
+        if item is None:
+            return
+        text = item_text(''.join(item))
+        state = self.lists[-1]
+        if state['continued']:
+            if text:
+                blank = '' if self.empty_marker else '\n'
+                self.output.write(f"{blank}{' ' * state['content']}{text}\n")
+                self.empty_marker = False
+        elif text or nested:
+            marker = f"{state['number']}." if state['ordered'] else '-'
+            # Only a first item with text, numbered 1 if ordered, can start
+            # a list right below a line of text
+            if state.pop('first', False) and (not text or state['number'] != 1) and \
+                    not self.empty_marker:
+                self.output.write('\n')
+            state['number'] += 1
+            state['content'] = state['indent'] + len(marker) + 1
+            state['continued'] = nested
+            self.empty_marker = not text
+            self.output.write(f"{' ' * state['indent']}{marker} {text}".rstrip() + '\n')
+
+    def break_inline(self):
+        # A list, table or heading in an item ends the links and emphasis
+        # open around it. The links are left out, as the tree converter
+        # does, and the emphasis is reopened for the item text after it.
+        if self.lists:
+            self.lists[-1]['reopen'] = [(frame['tag'], frame['attrs']) for frame in self.inline
+                                        if frame['tag'] in ('em', 'strong', 's')]
+        for frame in self.inline:
+            if frame['tag'] == 'a':
+                frame['nested'] = True
+
+    def resume_item(self):
+        # Text after a nested list, table or heading continues the item
+        if not self.lists:
+            return
+        reopen = self.lists[-1].pop('reopen', ())
+        if self.lists[-1]['continued']:
+            self.item = []
+            self.inline = [{'tag': tag, 'attrs': attrs, 'parts': [], 'text': [],
+                            'nested': False} for tag, attrs in reopen]
+
+    def start_list(self, tag, attrs):
+        self.flush_item(True)
+        if not self.lists:
+            self.output.write("\n\n")
+            self.empty_marker = False
+        start = attrs.get('start') or ''
+        self.lists.append({'ordered': tag == 'ol', 'continued': False, 'first': True,
+                           'number': int(start) if tag == 'ol' and start.isdigit() else 1,
+                           'indent': self.lists[-1]['content'] if self.lists else 2,
+                           'content': self.lists[-1]['content'] if self.lists else 2})
+
+    # ----- tables -----
+
+    def start_table(self, attrs):
+        self.table_depth = 1
+        self.list_table = {'attrs': attrs, 'caption': None, 'rows': 0,
+                           'columns': 0, 'cells': None, 'spans': {}, 'started': False}
+
+    def start_rows(self):
+        list_table = self.list_table
+        list_table['started'] = True
+        table_title = list_table['caption'] or ''
+        col_widths = (list_table['attrs'].get('data-column-widths') or '').split(',')
+        header_rows = int(list_table['attrs'].get('data-header-rows') or '1')
+
+        self.write_block(f"\n\n:::{{list-table}} {table_title}\n")
+        if col_widths and all(width.strip().isdigit() for width in col_widths):
+            self.write_block(f":widths: {' '.join(col_widths)}\n")
+        self.write_block(f":header-rows: {header_rows}\n\n")
+
+    def close_cell(self):
+        cell, self.cell = self.cell, None
+        if cell is None:
+            return
+        text = clean_text(''.join(cell)).replace('\n', '<br>')
+        text = re.sub(r'(<br>){2,}', '<br><br>', text)
+        if self.list_table['cells'] is None:
+            self.list_table['caption'] = text
+        else:
+            if self.list_table['rows'] == 0:
+                text = (text, header_text(''.join(self.cell_text)))
+            place_cell(self.list_table['cells'], self.list_table['spans'], text,
+                       *self.cell_span)
+
+    def close_row(self):
+        self.close_inline()
+        self.close_cell()
+        list_table = self.list_table
+        cells, list_table['cells'] = list_table['cells'], None
+        if cells is None:
+            return
+        end_row(cells, list_table['spans'])
+        if list_table['rows'] == 0:
+            list_table['columns'] = len(cells)
+        while len(cells) < list_table['columns']:
+            cells.append("")
+        list_table['rows'] += 1
+        if list_table['rows'] == 1:
+            # The header row is held until we know whether body rows follow
+            list_table['header'] = cells
+            return
+        self.write_header(True)
+        self.write_block("*   - " + "\n    - ".join(cells) + "\n")
+
+    def write_header(self, plain):
+        # As in HTMLToMarkdownConverter.handle_table, the header of a table
+        # with body rows is plain text and a header row alone keeps its markup
+        header = self.list_table.pop('header', None)
+        if header is not None:
+            cells = [cell[plain] if cell else "" for cell in header]
+            self.write_block("*   - " + "\n    - ".join(cells) + "\n")
+
+    def end_table(self):
+        self.close_row()
+        list_table = self.list_table
+        if list_table['started']:
+            if list_table['rows'] == 1:
+                # A header row alone is followed by an empty row, as in
+                # HTMLToMarkdownConverter.handle_table
+                self.write_header(False)
+                if list_table['columns']:
+                    self.write_block("*   - \n" + "    - \n" * (list_table['columns'] - 1))
+            self.write_block(":::\n\n")
+        self.list_table = None
+        self.table_depth = 0
+
+    def table_starttag(self, tag, attrs):
+        if tag == 'table':
+            self.table_depth += 1
+        elif tag == 'br':
+            self.emit('\n')
+        elif self.table_depth > 1:
+            if tag == 'tr':
+                self.emit('\n')
+        elif tag == 'caption':
+            self.cell = []
+        elif tag == 'tr':
+            self.close_row()
+            if not self.list_table['started']:
+                self.start_rows()
+            self.list_table['cells'] = []
+        elif tag in ('td', 'th'):
+            self.close_inline()
+            self.close_cell()
+            if self.list_table['cells'] is None:
+                self.table_starttag('tr', {})
+            self.cell = []
+            self.cell_text = []
+            self.cell_span = (span_value(attrs.get('colspan'), 1000),
+                              span_value(attrs.get('rowspan'), 65534))
+
+    def table_endtag(self, tag):
+        if tag == 'table':
+            if self.table_depth == 1:
+                self.end_table()
+                self.resume_item()
+            else:
+                self.table_depth -= 1
+        elif tag in cell_block_tags:
+            # Blocks in a cell end with a line break, as in render_inline
+            self.emit('\n')
+        elif self.table_depth > 1:
+            if tag in ('td', 'th'):
+                self.emit(' ')
+        elif tag == 'caption':
+            self.close_inline()
+            self.close_cell()
+        elif tag in ('td', 'th'):
+            self.close_inline()
+            self.close_cell()
+        elif tag == 'tr':
+            self.close_row()
+
+    # ----- parser events -----
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.skip_depth:
+            if tag == self.skip_tag:
+                self.skip_depth += 1
+            return
+        if self.noise.matches(tag, attrs):
+            self.skip_tag = tag
+            self.skip_depth = 1
+            return
+        if tag in preserve_whitespace_tags:
+            self.preserve_depth += 1
+
+        if tag in ('img', 'a'):
+            for frame in self.inline:
+                frame['nested'] = True
+        if tag == 'img':
+            self.image(attrs)
+        elif self.block and self.block['tag'] in heading_tags and tag in inline_tags:
+            if tag in ('a', 'em', 'strong'):
+                self.heading_inline(tag, attrs)
+        elif tag in inline_tags:
+            self.inline.append({'tag': tag, 'attrs': attrs, 'parts': [], 'text': [],
+                                'nested': False})
+        elif self.table_depth:
+            self.table_starttag(tag, attrs)
+        elif tag in block_tags:
+            if tag == 'table' or tag in list_tags or tag in heading_tags:
+                self.break_inline()
+            self.close_inline()
+            self.close_block()
+            if tag == 'table':
+                self.flush_item(True)
+                self.start_table(attrs)
+            elif tag in list_tags:
+                self.start_list(tag, attrs)
+            elif self.item is None and tag == 'p':
+                self.block = {'tag': tag, 'attrs': attrs, 'parts': []}
+            elif tag in heading_tags:
+                self.flush_item(True)
+                self.block = {'tag': tag, 'attrs': attrs, 'parts': [], 'open': [],
+                              'after': None if self.lists else []}
+        elif tag == 'li' and self.lists:
+            self.close_inline()
+            self.flush_item()
+            self.lists[-1]['continued'] = False
+            self.item = []
+        elif tag == 'br':
+            self.emit('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in ('img', 'br'):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.skip_depth:
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+            return
+        if tag in preserve_whitespace_tags and self.preserve_depth:
+            self.preserve_depth -= 1
+
+        if tag in inline_tags and any(frame['tag'] == tag for frame in self.inline):
+            # Close the innermost matching frame and anything left open in it
+            while True:
+                frame = self.inline.pop()
+                text = self.render_inline(frame)
+                if self.inline and frame['tag'] != tag:
+                    self.inline[-1]['parts'].append(text)
+                    continue
+                self.emit(text)
+                if frame['tag'] == tag:
+                    break
+        elif self.block is not None and self.block['tag'] in heading_tags and \
+                tag in ('a', 'em', 'strong'):
+            self.heading_inline_end(tag)
+        elif self.table_depth:
+            self.table_endtag(tag)
+        elif self.block is not None and tag == self.block['tag']:
+            self.close_inline()
+            self.close_block()
+            if tag in heading_tags:
+                self.resume_item()
+        elif tag == 'li' and self.lists:
+            self.close_inline()
+            self.flush_item()
+        elif tag in list_tags and self.lists:
+            self.close_inline()
+            self.flush_item()
+            self.lists.pop()
+            if not self.lists:
+                self.output.write("\n")
+            self.resume_item()
+        elif tag in item_block_tags and self.item is not None:
+            self.emit('\n')
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if not self.preserve_depth and not data.strip(ascii_spaces):
+            # Whitespace alone becomes one newline or space, as in the tree
+            data = '\n' if '\n' in data else ' '
+        parts = self.target()
+        if parts is not None:
+            parts.append(data)
+        for frame in self.inline:
+            frame['text'].append(data)
+        if self.cell is not None:
+            self.cell_text.append(data)
+
+    def close(self):
+        super().close()
+        self.close_inline()
+        self.close_block()
+        self.flush_item()
+        if self.table_depth:
+            self.end_table()
+        self.output.close()
+
+    def convert(self, source):
+        # Reads a file object in chunks; returns the Markdown when the
+        # converter was created without an output file
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            self.feed(chunk)
+        self.close()
+        return None if self.output.file else self.output.getvalue()